@@ -11,6 +11,54 @@ MAN2HTML = os.path.join(TOOLSDIR, 'w3mman2html.cgi')
 # host to pass into Flask's app.run.
 HOST_IP = os.getenv('HOST_IP', False)
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost')
+
+# options passed to pymongo.MongoClient by stores shared between requests
+# (see store.shared)
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 10))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 2000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 5000))
+
+# store.findmanpage caches the results of the last STORE_CACHE_LOOKUPS names it
+# was asked about, and decoded man pages up to a total of STORE_CACHE_PARAGRAPHS
+# paragraphs. the caches are dropped whenever the corpus generation changes,
+# which is checked at most once every STORE_GENERATION_INTERVAL seconds
+STORE_CACHE_LOOKUPS = int(os.getenv('STORE_CACHE_LOOKUPS', 2000))
+STORE_CACHE_PARAGRAPHS = int(os.getenv('STORE_CACHE_PARAGRAPHS', 200000))
+STORE_GENERATION_INTERVAL = float(os.getenv('STORE_GENERATION_INTERVAL', 5))
+
+# paragraph text is stored once per distinct text (see store.store), the last
+# STORE_CACHE_TEXTS bytes of it that were read are kept and shared by all the
+# man pages that contain it. unlike the other caches this one is never dropped
+STORE_CACHE_TEXTS = int(os.getenv('STORE_CACHE_TEXTS', 64 * 1024 * 1024))
+
+# texts of at least STORE_COMPRESS_TEXT bytes are stored zlib compressed and
+# decompressed the first time they're accessed, 0 stores all texts as is.
+# either way texts that are already stored are read
+STORE_COMPRESS_TEXT = int(os.getenv('STORE_COMPRESS_TEXT', 0))
+
+# shared stores run the lookups of a command line on this many threads (see
+# store.concurrentstore), 1 runs them one after the other. the command words
+# of a command line are already resolved with a single query, only names with
+# a section or a .gz suffix get threads of their own, so this only pays off
+# for traffic that has many of those
+STORE_THREADS = int(os.getenv('STORE_THREADS', 1))
+
+# explaining a command line fetches only the synopsis and the first
+# STORE_EXPLAIN_OPTIONS options of a man page, the rest are fetched one at a
+# time as the command line uses them
+STORE_EXPLAIN_OPTIONS = int(os.getenv('STORE_EXPLAIN_OPTIONS', 200))
+
+# the matcher keeps the parsed ast of the last MATCHER_CACHE_PARSES command
+# lines it was given
+MATCHER_CACHE_PARSES = int(os.getenv('MATCHER_CACHE_PARSES', 10000))
+
+# the web tier keeps the last WEB_CACHE_EXPLAINS bytes of explained command
+# lines it rendered, until the corpus changes
+WEB_CACHE_EXPLAINS = int(os.getenv('WEB_CACHE_EXPLAINS', 32 * 1024 * 1024))
+
+# serve the web tier from this snapshot file instead of mongodb (see
+# snapshot.py and manager.py --snapshot)
+SNAPSHOT = os.getenv('SNAPSHOT')
 DEBUG = True
 
 LOGGING_DICT = {
@@ -0,0 +1,157 @@
+'''a portable dump of the processed man pages and mappings of a store, used to
+seed a new db without processing the man pages again
+
+a dump is a stream of records:
+
+    header - magic and format version
+    records - kind (one byte), length and a bson document: first the manpage
+              documents (with their text in place and their _id), then the
+              mapping documents
+    trailer - a record with the number of records and the sha1 of everything
+              before it
+
+the whole file is checked before anything is loaded from it.
+'''
+import struct, hashlib, itertools, logging
+
+import bson
+
+from explainshell import util
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'ESDUMP'
+VERSION = 1
+
+MANPAGE = 'm'
+MAPPING = 'p'
+TRAILER = 'e'
+
+_header = struct.Struct('<6sH')
+_record = struct.Struct('<cI')
+
+def write(path, manpages, mappings):
+    '''write a dump to path
+
+    manpages is an iterable of (id, store.manpage), mappings is an iterable of
+    (src, id, score)
+
+    the dump is written with util.atomicwrite'''
+    h = hashlib.sha1()
+    n = [0]
+    with util.atomicwrite(path) as f:
+        def put(data):
+            h.update(data)
+            f.write(data)
+        def record(kind, d):
+            data = bson.BSON.encode(d)
+            put(_record.pack(kind, len(data)))
+            put(data)
+            n[0] += 1
+
+        put(_header.pack(MAGIC, VERSION))
+        for oid, m in manpages:
+            d = m.to_store()
+            d['_id'] = oid
+            record(MANPAGE, d)
+        nmanpages = n[0]
+        for src, dst, score in mappings:
+            record(MAPPING, {'src' : src, 'dst' : dst, 'score' : score})
+
+        data = bson.BSON.encode({'records' : n[0], 'sha1' : h.hexdigest()})
+        f.write(_record.pack(TRAILER, len(data)))
+        f.write(data)
+
+    logger.info('wrote dump %s with %d manpages and %d mappings',
+                path, nmanpages, n[0] - nmanpages)
+
+def export(s, path):
+    '''write the contents of store s to a dump at path'''
+    write(path, s.manpages(), s.mappingtuples())
+
+def _records(f):
+    '''yield (kind, data) for the records in f, after its header'''
+    while True:
+        header = f.read(_record.size)
+        if not header:
+            return
+        if len(header) != _record.size:
+            raise ValueError('truncated record header')
+        kind, length = _record.unpack(header)
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError('truncated record')
+        yield kind, data
+
+def _open(path):
+    f = open(path, 'rb')
+    header = f.read(_header.size)
+    if len(header) != _header.size:
+        f.close()
+        raise ValueError('%r is not a dump' % path)
+    magic, version = _header.unpack(header)
+    if magic != MAGIC:
+        f.close()
+        raise ValueError('%r is not a dump' % path)
+    if version != VERSION:
+        f.close()
+        raise ValueError('dump %r has version %d, expected %d' % (path, version, VERSION))
+    return f, header
+
+def check(path):
+    '''raise ValueError unless the dump at path is complete and intact, return
+    the number of records in it'''
+    f, header = _open(path)
+    with f:
+        h = hashlib.sha1(header)
+        n = 0
+        for kind, data in _records(f):
+            if kind == TRAILER:
+                trailer = bson.BSON(data).decode()
+                if f.read(1):
+                    raise ValueError('dump %r has data after its trailer' % path)
+                if trailer['records'] != n or trailer['sha1'] != h.hexdigest():
+                    raise ValueError('dump %r is corrupt, checksum mismatch' % path)
+                return n
+            if kind not in (MANPAGE, MAPPING):
+                raise ValueError('dump %r has a record of unknown kind %r' % (path, kind))
+            h.update(_record.pack(kind, len(data)))
+            h.update(data)
+            n += 1
+    raise ValueError('dump %r is truncated, it has no trailer' % path)
+
+def read(path):
+    '''yield (kind, document) for the records of the dump at path, which is
+    checked first'''
+    check(path)
+    f, header = _open(path)
+    with f:
+        for kind, data in _records(f):
+            if kind == TRAILER:
+                return
+            yield kind, bson.BSON(data).decode()
+
+def load(s, path, batchsize=500):
+    '''load the dump at path into store s, whose corpus must be empty
+
+    documents are inserted in batches of batchsize. indexes and lookup are
+    built at the end by migrating the corpus. return the number of loaded
+    man pages and mappings'''
+    if s.manpage.find_one() or s.mapping.find_one():
+        raise ValueError('corpus %r of db %r is not empty' % (s.corpus, s.db.name))
+
+    counts = {MANPAGE : 0, MAPPING : 0}
+    for kind, records in itertools.groupby(read(path), key=lambda (kind, d): kind):
+        for batch in util.chunks((d for kind, d in records), batchsize):
+            if kind == MANPAGE:
+                s.bulkinsert(manpages=batch)
+            else:
+                s.bulkinsert(mappings=batch)
+            counts[kind] += len(batch)
+            logger.info('loaded %d manpages and %d mappings', counts[MANPAGE], counts[MAPPING])
+
+    # a corpus that was already migrated while empty has its indexes, but
+    # still needs its lookup
+    if not s.migrate():
+        s.rebuildlookup()
+    return counts[MANPAGE], counts[MAPPING]
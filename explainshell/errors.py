@@ -3,3 +3,6 @@ class ProgramDoesNotExist(Exception):
 
 class EmptyManpage(Exception):
     pass
+
+class SchemaOutdated(Exception):
+    pass
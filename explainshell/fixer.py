@@ -74,13 +74,18 @@ class runner(object):
         for f in self._fixers():
             f.post_classify()
 
+    # fixers change the paragraphs of the (store) manpage in place from here
+    # on
+
     def post_option_extraction(self):
         for f in self._fixers():
             f.post_option_extraction()
+        self.mctx.manpage.invalidate()
 
     def pre_add_manpage(self):
         for f in self._fixers():
             f.pre_add_manpage()
+        self.mctx.manpage.invalidate()
 
 def register(fixercls):
     fixerscls.append(fixercls)
@@ -1,6 +1,6 @@
 import sys, os, argparse, logging, glob
 
-from explainshell import options, store, fixer, manpage, errors, util, config
+from explainshell import dump, options, store, fixer, manpage, errors, util, config, snapshot
 from explainshell.algo import classifier
 
 logger = logging.getLogger('explainshell.manager')
@@ -19,18 +19,24 @@ class managerctx(object):
 
 class manager(object):
     '''the manager uses all parts of the system to read, classify, parse, extract
-    and write a man page to the database'''
-    def __init__(self, dbhost, dbname, paths, overwrite=False, drop=False):
+    and write a man page to the database
+
+    processed man pages are written in batches of batchsize to corpus, or to
+    the corpus that is active when the manager is created if it's None'''
+    def __init__(self, dbhost, dbname, paths, overwrite=False, drop=False, batchsize=100,
+                 corpus=None):
         self.paths = paths
         self.overwrite = overwrite
+        self.batchsize = batchsize
 
-        self.store = store.store(dbname, dbhost)
+        self.store = store.store(dbname, dbhost, corpus)
 
         self.classifier = classifier.classifier(self.store, 'bayes')
         self.classifier.train()
 
         if drop:
             self.store.drop(True)
+        self.store.migrate()
 
     def ctx(self, m):
         return managerctx(self.classifier, self.store, m)
@@ -57,23 +63,31 @@ class manager(object):
         if not ctx.manpage.options:
             logger.warn("couldn't find any options for manpage %s", ctx.manpage.name)
 
-    def _write(self, ctx, frunner):
-        frunner.pre_add_manpage()
-        return ctx.store.addmanpage(ctx.manpage)
-
     def _update(self, ctx, frunner):
         frunner.pre_add_manpage()
         return ctx.store.updatemanpage(ctx.manpage)
 
-    def process(self, ctx):
+    def _prepare(self, ctx):
+        '''read, classify and extract the options of the man page in ctx, and
+        return it ready to be written to the store'''
         frunner = fixer.runner(ctx)
 
         self._read(ctx, frunner)
         self._classify(ctx, frunner)
         self._extract(ctx, frunner)
 
-        m = self._write(ctx, frunner)
-        return m
+        frunner.pre_add_manpage()
+        return ctx.manpage
+
+    def process(self, ctx):
+        m = self._prepare(ctx)
+        return ctx.store.addmanpage(m)
+
+    def _flush(self, manpages):
+        if manpages:
+            stats = self.store.addmanpages(manpages)
+            logger.info('wrote a batch of %d manpages: %r', len(manpages), stats)
+        return manpages
 
     def edit(self, m, paragraphs=None):
         ctx = self.ctx(m)
@@ -91,6 +105,7 @@ class manager(object):
     def run(self):
         added = []
         exists = []
+        pending = []
         for path in self.paths:
             try:
                 m = manpage.manpage(path)
@@ -108,11 +123,23 @@ class manager(object):
                 except errors.ProgramDoesNotExist:
                     pass
 
-                # the manpage is not in the data store; process and add it
+                # two paths with the same basename map to the same source,
+                # don't add both in one batch
+                dup = [i for i, x in enumerate(pending) if x.source == m.source]
+                if dup:
+                    if not self.overwrite:
+                        logger.info('manpage %r already pending, not overwriting it', m.name)
+                        exists.append(m)
+                        continue
+                    del pending[dup[0]]
+
+                # the manpage is not in the data store; process it and add it
+                # with the next batch
                 ctx = self.ctx(m)
-                m = self.process(ctx)
-                if m:
-                    added.append(m)
+                pending.append(self._prepare(ctx))
+                if len(pending) >= self.batchsize:
+                    added.extend(self._flush(pending))
+                    pending = []
             except errors.EmptyManpage, e:
                 logger.error('manpage %r is empty!', e.args[0])
             except ValueError:
@@ -122,6 +149,8 @@ class manager(object):
             except:
                 logger.fatal('uncaught exception when handling manpage %s', path)
                 raise
+        added.extend(self._flush(pending))
+
         if not added:
             logger.warn('no manpages added')
         else:
@@ -159,12 +188,80 @@ class manager(object):
 
         return mappingstoadd, multicommands
 
-def main(files, dbname, dbhost, overwrite, drop, verify):
-    if verify:
+def _activate(dbname, dbhost, corpus):
+    s = store.store(dbname, dbhost, corpus)
+    ok = s.verify()[0]
+    if not ok:
+        print 'corpus %r failed verification, not activating it' % s.corpus
+        return 1
+    previous = s.activate()
+    print 'activated corpus %r, previous corpus %r is kept for --rollback' % (s.corpus, previous)
+    return 0
+
+def _textstats(dbname, dbhost, corpus):
+    s = store.store(dbname, dbhost, corpus)
+    total = [0, 0, 0.0]
+    for source, size, stored, seconds in s.textstats():
+        print '%s: %d bytes, %d stored (%.2f), %.2fms to decompress' % (
+            source, size, stored, float(stored) / (size or 1), seconds * 1000)
+        total[0] += size
+        total[1] += stored
+        total[2] += seconds
+    size, stored, seconds = total
+    print 'total: %d bytes, %d stored (%.2f), %.2fms to decompress' % (
+        size, stored, float(stored) / (size or 1), seconds * 1000)
+    return 0
+
+def main(files, dbname, dbhost, overwrite, drop, verify, snapshotpath=None,
+         rebuildlookup=False, migrate=False, corpus=None, activate=False, rollback=False,
+         textstats=False, exportpath=None, importpath=None):
+    if textstats:
+        return _textstats(dbname, dbhost, corpus)
+
+    if exportpath:
+        s = store.store(dbname, dbhost, corpus)
+        dump.export(s, exportpath)
+        return 0
+
+    if importpath:
+        s = store.store(dbname, dbhost, corpus)
+        if drop and raw_input('really drop db (y/n)? ').strip().lower() == 'y':
+            s.drop(True)
+        nmanpages, nmappings = dump.load(s, importpath)
+        print 'loaded %d manpages and %d mappings into corpus %r' % (nmanpages, nmappings, s.corpus)
+        if activate:
+            return _activate(dbname, dbhost, s.corpus)
+        return 0
+
+    if rollback:
         s = store.store(dbname, dbhost)
-        ok = s.verify()
+        print 'rolled back to corpus %r' % s.rollback()
+        return 0
+
+    if activate and not files:
+        return _activate(dbname, dbhost, corpus)
+
+    if migrate:
+        s = store.store(dbname, dbhost, corpus)
+        n = s.migrate()
+        print 'applied %d migrations, schema version is %d' % (n, store.SCHEMAVERSION)
+        return 0
+
+    if verify:
+        s = store.store(dbname, dbhost, corpus)
+        ok = s.verify()[0]
         return 0 if ok else 1
 
+    if rebuildlookup:
+        s = store.store(dbname, dbhost, corpus)
+        s.rebuildlookup()
+        return 0
+
+    if snapshotpath:
+        s = store.store(dbname, dbhost, corpus)
+        snapshot.export(s, snapshotpath)
+        return 0
+
     if drop:
         if raw_input('really drop db (y/n)? ').strip().lower() != 'y':
             drop = False
@@ -179,13 +276,16 @@ def main(files, dbname, dbhost, overwrite, drop, verify):
         else:
             gzs.add(os.path.abspath(path))
 
-    m = manager(dbhost, dbname, gzs, overwrite, drop)
+    m = manager(dbhost, dbname, gzs, overwrite, drop, corpus=corpus)
     added, exists = m.run()
     for mp in added:
         print 'successfully added %s' % mp.source
     if exists:
         print 'these manpages already existed and werent overwritten: \n\n%s' % '\n'.join([m.path for m in exists])
 
+    if activate:
+        return _activate(dbname, dbhost, m.store.corpus)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='process man pages and save them in the store')
     parser.add_argument('--log', type=str, default='ERROR', help='use log as the logger log level')
@@ -194,8 +294,19 @@ if __name__ == '__main__':
     parser.add_argument('--db', default='explainshell', help='mongo db name')
     parser.add_argument('--host', default=config.MONGO_URI, help='mongo host')
     parser.add_argument('--verify', action='store_true', default=False, help='verify db integrity')
+    parser.add_argument('--snapshot', metavar='PATH', help='export the store to a snapshot file at PATH')
+    parser.add_argument('--migrate', action='store_true', default=False, help='create indexes and migrate the db to the current schema version')
+    parser.add_argument('--rebuild-lookup', action='store_true', default=False, help='rebuild the name lookup collection from mapping and manpage')
+    parser.add_argument('--corpus', help='work on the corpus with this name instead of the active one')
+    parser.add_argument('--activate', action='store_true', default=False, help='verify the corpus and make it the one the site is served from')
+    parser.add_argument('--rollback', action='store_true', default=False, help='serve the site from the corpus that was active before the last --activate')
+    parser.add_argument('--text-stats', action='store_true', default=False, help='print the size, stored size and decompression time of the text of every man page')
+    parser.add_argument('--export', metavar='PATH', help='dump the processed man pages and mappings to PATH')
+    parser.add_argument('--import', dest='import_', metavar='PATH', help='load a dump made by --export into an empty corpus (see --drop)')
     parser.add_argument('files', nargs='*')
 
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.log.upper()))
-    sys.exit(main(args.files, args.db, args.host, args.overwrite, args.drop, args.verify))
+    sys.exit(main(args.files, args.db, args.host, args.overwrite, args.drop, args.verify, args.snapshot,
+                  args.rebuild_lookup, args.migrate, args.corpus, args.activate, args.rollback,
+                  args.text_stats, args.export, args.import_))
@@ -1,9 +1,10 @@
-import collections, logging, itertools
+import collections, logging, itertools, cgi, multiprocessing
 
 import bashlex.parser
 import bashlex.ast
+import bashlex.errors
 
-from explainshell import errors, util, helpconstants
+from explainshell import errors, util, helpconstants, config
 
 class matchgroup(object):
     '''a class to group matchresults together
@@ -27,6 +28,48 @@ matchwordexpansion = collections.namedtuple('matchwordexpansion',
 
 logger = logging.getLogger(__name__)
 
+class commandwords(bashlex.ast.nodevisitor):
+    '''collect the words that the matcher might look up in the store: the
+    first word of every simple command, and the first two words together in
+    case the first one is a multicommand'''
+    def __init__(self):
+        self.words = []
+
+    def visitcommand(self, node, parts):
+        words = [part for part in parts if part.kind == 'word']
+        if words and not words[0].parts:
+            self.words.append(words[0].word)
+            if len(words) > 1 and not words[1].parts:
+                self.words.append('%s %s' % (words[0].word, words[1].word))
+
+    def visitcommandsubstitution(self, node, command):
+        # the matcher doesn't look inside substitutions
+        return False
+
+    def visitprocesssubstitution(self, node, command):
+        return False
+
+# the outcomes of parsing command lines, shared by all matchers. the matcher
+# doesn't modify the nodes it visits so they're reused as is
+_parses = util.lrucache(config.MATCHER_CACHE_PARSES)
+
+def parse(s):
+    '''parse s the way the matcher does, the ast (or the error raised while
+    parsing) is cached by s. the ast must not be modified'''
+    try:
+        result = _parses[s]
+    except KeyError:
+        try:
+            # limit recursive parsing to a depth of 1
+            result = bashlex.parser.parsesingle(s, expansionlimit=1,
+                                                strictmode=False)
+        except (bashlex.errors.ParsingError, NotImplementedError), e:
+            result = e
+        _parses[s] = result
+    if isinstance(result, Exception):
+        raise result
+    return result
+
 class matcher(bashlex.ast.nodevisitor):
     '''parse a command line and return a list of matchresults describing
     each token.
@@ -36,6 +79,8 @@ class matcher(bashlex.ast.nodevisitor):
         self.store = store
         self._prevoption = self._currentoption = None
         self.groups = [matchgroup('shell')]
+        # the number of command groups in groups
+        self._commandgroups = 0
 
         # a list of matchwordexpansions where expansions happened during word
         # expansion
@@ -60,9 +105,31 @@ class matcher(bashlex.ast.nodevisitor):
         # show up as unknown or be taken from the db
         self.functions = set()
 
+        # maps command words to the results of looking them up in the store
+        # ahead of time, see _prefetch
+        self._prefetched = {}
+
+        # ids of the word nodes that startcommand matched as (part of) the
+        # name of a command, they're skipped instead of being visited as
+        # arguments
+        self._consumed = set()
+
     def _generatecommandgroupname(self):
-        existing = len([g for g in self.groups if g.name.startswith('command')])
-        return 'command%d' % existing
+        name = 'command%d' % self._commandgroups
+        self._commandgroups += 1
+        return name
+
+    def visit(self, node):
+        if id(node) not in self._consumed:
+            super(matcher, self).visit(node)
+
+    def _findfirstword(self, parts):
+        '''the index of the first word node in parts that wasn't consumed, or
+        -1'''
+        for i, part in enumerate(parts):
+            if part.kind == 'word' and id(part) not in self._consumed:
+                return i
+        return -1
 
     @property
     def matches(self):
@@ -87,10 +154,22 @@ class matcher(bashlex.ast.nodevisitor):
         logger.debug('looking up option %r, got %r', opt, self._currentoption)
         return self._currentoption
 
+    def complete_option(self, prefix):
+        # flags are unicode, like the names in findmanpages
+        prefix = prefix.decode('latin1')
+        self._currentoption, completions = self.manpage.complete_option(prefix)
+        logger.debug('completing option %r, got %r (%r)', prefix,
+                     self._currentoption, completions)
+        return self._currentoption, completions
+
     def findmanpages(self, prog):
         prog = prog.decode('latin1')
         logger.info('looking up %r in store', prog)
-        manpages = self.store.findmanpage(prog)
+        manpages = self._prefetched.get(prog)
+        if manpages is None:
+            manpages = self.store.findmanpage(prog, explain=True)
+        elif isinstance(manpages, errors.ProgramDoesNotExist):
+            raise manpages
         logger.info('found %r in store, got: %r, using %r', prog, manpages, manpages[0])
         return manpages
 
@@ -237,7 +316,7 @@ class matcher(bashlex.ast.nodevisitor):
     def startcommand(self, commandnode, parts, endword, addgroup=True):
         logger.info('startcommand commandnode=%r parts=%r, endword=%r, addgroup=%s',
                     commandnode, parts, endword, addgroup)
-        idxwordnode = bashlex.ast.findfirstkind(parts, 'word')
+        idxwordnode = self._findfirstword(parts)
         assert idxwordnode != -1
 
         wordnode = parts[idxwordnode]
@@ -258,9 +337,9 @@ class matcher(bashlex.ast.nodevisitor):
 
         try:
             mps = self.findmanpages(wordnode.word)
-            # we consume this node here, pop it from parts so we
-            # don't visit it again as an argument
-            parts.pop(idxwordnode)
+            # we consume this node here so we don't visit it again as an
+            # argument
+            self._consumed.add(id(wordnode))
         except errors.ProgramDoesNotExist, e:
             if addgroup:
                 # add a group for this command, we'll mark it as unknown
@@ -278,7 +357,7 @@ class matcher(bashlex.ast.nodevisitor):
             return False
 
         manpage = mps[0]
-        idxnextwordnode = bashlex.ast.findfirstkind(parts, 'word')
+        idxnextwordnode = self._findfirstword(parts)
 
         # check the next word for a possible multicommand if:
         # - the matched manpage says so
@@ -291,9 +370,9 @@ class matcher(bashlex.ast.nodevisitor):
                 logger.info('%r is a multicommand, trying to get another token and look up %r', manpage, multi)
                 mps = self.findmanpages(multi)
                 manpage = mps[0]
-                # we consume this node here, pop it from parts so we
-                # don't visit it again as an argument
-                parts.pop(idxnextwordnode)
+                # we consume this node here so we don't visit it again as an
+                # argument
+                self._consumed.add(id(nextwordnode))
                 endpos = nextwordnode.pos[1]
             except errors.ProgramDoesNotExist:
                 logger.info('no manpage %r for multicommand %r', multi, manpage)
@@ -398,8 +477,11 @@ class matcher(bashlex.ast.nodevisitor):
             if word.startswith('--'):
                 word = word.split('=', 1)[0]
             option = self.find_option(word)
+            completions = None
+            if not option and word.startswith('--') and word != '--':
+                option, completions = self.complete_option(word)
             if option:
-                logger.info('found an exact match for %r: %r', word, option)
+                logger.info('found a match for %r: %r', word, option)
                 mr = matchresult(node.pos[0], node.pos[1], option.text, None)
                 self.matches.append(mr)
 
@@ -408,6 +490,13 @@ class matcher(bashlex.ast.nodevisitor):
                 # an argument
                 if word != node.word:
                     self._currentoption = None
+            elif completions:
+                logger.info('%r is an ambiguous abbreviation of %r', word, completions)
+                text = helpconstants.AMBIGUOUSOPTION % (
+                    cgi.escape(word.decode('latin1')),
+                    u', '.join(u'<b>%s</b>' % cgi.escape(f) for f in completions))
+                text = text.encode('utf8')
+                self.matches.append(matchresult(node.pos[0], node.pos[1], text, None))
             else:
                 word = node.word
 
@@ -456,17 +545,17 @@ class matcher(bashlex.ast.nodevisitor):
                             self.matches.extend(m)
                             return
 
-                    if self.manpage.arguments:
+                    arguments = self.manpage.arguments
+                    if arguments:
                         if self.manpage.nestedcommand:
                             logger.info('manpage %r can nest commands', self.manpage)
                             if self.startcommand(None, [node], self.manpage.nestedcommand, addgroup=False):
                                 self._currentoption = None
                                 return
 
-                        d = self.manpage.arguments
-                        k = list(d.keys())[0]
+                        k = next(iter(arguments))
                         logger.info('got arguments, using %r', k)
-                        text = d[k]
+                        text = arguments[k]
                         mr = matchresult(node.pos[0], node.pos[1], text, None)
                         self.matches.append(mr)
                         return
@@ -534,10 +623,9 @@ class matcher(bashlex.ast.nodevisitor):
     def match(self):
         logger.info('matching string %r', self.s)
 
-        # limit recursive parsing to a depth of 1
-        self.ast = bashlex.parser.parsesingle(self.s, expansionlimit=1,
-                                              strictmode=False)
+        self.ast = parse(self.s)
         if self.ast:
+            self._prefetch()
             self.visit(self.ast)
             assert len(self.groupstack) == 1, 'groupstack should contain only shell group after matching'
 
@@ -554,6 +642,7 @@ class matcher(bashlex.ast.nodevisitor):
             return s
 
         self._markunparsedunknown()
+        resultindex = self._resultindex()
 
         # fix each matchgroup seperately
         for group in self.groups:
@@ -563,7 +652,7 @@ class matcher(bashlex.ast.nodevisitor):
                     # something as its synopsis)
                     assert not group.results[0].unknown
 
-                group.results = self._mergeadjacent(group.results)
+                group.results = self._mergeadjacent(group.results, resultindex)
 
                 # add matchresult.match to existing matches
                 for i, m in enumerate(group.results):
@@ -579,35 +668,46 @@ class matcher(bashlex.ast.nodevisitor):
 
         return self.groups
 
+    def _prefetch(self):
+        '''look up all the command words in the ast in one batch, instead of
+        one by one as we visit them'''
+        v = commandwords()
+        v.visit(self.ast)
+        if v.words:
+            words = [w.decode('latin1') for w in v.words]
+            logger.info('prefetching %r', words)
+            self._prefetched = self.store.findmanpages(words, explain=True)
+
     def _markunparsedunknown(self):
         '''the parser may leave a remainder at the end of the string if it doesn't
         match any of the rules, mark them as unknowns'''
-        parsed = [False]*len(self.s)
-
-        # go over all existing matches to see if we've covered the
-        # current position
-        for start, end, _, _ in self.allmatches:
-            for i in range(start, end):
-                parsed[i] = True
-
-        for i in range(len(parsed)):
+        # the parser ignores comments but we can use a trick to see if this
+        # starts a comment and is beyond the ending index of the parsed
+        # portion of the inpnut
+        commentstart = self.s.find('#', self.ast.pos[1] + 1 if self.ast else 0)
+        if commentstart == -1:
+            commentstart = len(self.s)
+
+        # walk the gaps between the existing matches (which don't overlap) up
+        # to the comment
+        unparsed = []
+        pos = 0
+        for start, end, _, _ in sorted(self.allmatches, key=lambda mr: mr.start):
+            unparsed.extend(xrange(pos, min(start, commentstart)))
+            pos = max(pos, end)
+        unparsed.extend(xrange(pos, commentstart))
+
+        for i in unparsed:
             c = self.s[i]
             # whitespace is always 'unparsed'
-            if c.isspace():
-                parsed[i] = True
-
-            # the parser ignores comments but we can use a trick to see if this
-            # starts a comment and is beyond the ending index of the parsed
-            # portion of the inpnut
-            if (not self.ast or i > self.ast.pos[1]) and c == '#':
-                comment = matchresult(i, len(parsed), helpconstants.COMMENT, None)
-                self.groups[0].results.append(comment)
-                break
-
-            if not parsed[i]:
+            if not c.isspace():
                 # add unparsed results to the 'shell' group
                 self.groups[0].results.append(self.unknown(c, i, i+1))
 
+        if commentstart < len(self.s):
+            comment = matchresult(commentstart, len(self.s), helpconstants.COMMENT, None)
+            self.groups[0].results.append(comment)
+
         # there are no overlaps, so sorting by the start is enough
         self.groups[0].results.sort(key=lambda mr: mr.start)
 
@@ -621,9 +721,11 @@ class matcher(bashlex.ast.nodevisitor):
             i += 1
         return d
 
-    def _mergeadjacent(self, matches):
+    def _mergeadjacent(self, matches, resultindex):
+        '''merge continuous runs of matches with the same text, resultindex is
+        the shared index of all matches (see _resultindex), it's updated with
+        the merged matches'''
         merged = []
-        resultindex = self._resultindex()
         sametext = itertools.groupby(matches, lambda m: m.text)
         for text, ll in sametext:
             for l in util.groupcontinuous(ll, key=lambda m: resultindex[m]):
@@ -638,3 +740,177 @@ class matcher(bashlex.ast.nodevisitor):
                     merged.append(matchresult(start, end, text, None))
                     resultindex[merged[-1]] = endindex
         return merged
+
+# the outcome of explaining one of the commands given to matchmany, groups
+# and expansions are those of a matcher that matched it, or error is what
+# matching it raised
+batchresult = collections.namedtuple('batchresult', 'command groups expansions error')
+
+_batcherrors = (bashlex.errors.ParsingError, errors.ProgramDoesNotExist, NotImplementedError)
+
+def _dumperror(e):
+    '''a picklable form of e, ParsingError can't be unpickled as is'''
+    if isinstance(e, bashlex.errors.ParsingError):
+        return type(e), (e.message, e.s, e.position)
+    return type(e), e.args
+
+def _loaderror((cls, args)):
+    return cls(*args)
+
+class _lookupstore(object):
+    '''answers the lookups of the matchers in a matchmany worker from the
+    results that were looked up for them ahead of time, and records the names
+    that weren't'''
+    def __init__(self, lookups):
+        self.lookups = lookups
+        self.missing = set()
+
+    def findmanpage(self, name, explain=False):
+        try:
+            result = self.lookups[name]
+        except KeyError:
+            self.missing.add(name)
+            raise errors.ProgramDoesNotExist(name)
+        if isinstance(result, errors.ProgramDoesNotExist):
+            raise result
+        return result
+
+    def findmanpages(self, names, explain=False):
+        results = {}
+        for name in names:
+            try:
+                results[name] = self.findmanpage(name)
+            except errors.ProgramDoesNotExist, e:
+                results[name] = e
+        return results
+
+def _parsemany(commands):
+    '''runs in a matchmany worker: return (words, error) for every command in
+    commands, words are the names the matcher looks up ahead of time'''
+    results = []
+    for command in commands:
+        try:
+            ast = parse(command.encode('latin1', 'replace'))
+        except _batcherrors, e:
+            results.append((None, _dumperror(e)))
+            continue
+        v = commandwords()
+        if ast:
+            v.visit(ast)
+        results.append(([w.decode('latin1') for w in v.words], None))
+    return results
+
+def _matchmany((commands, lookups)):
+    '''runs in a matchmany worker: match every command in commands, with the
+    man pages in lookups. return a (kind, value) for each:
+
+    - ('ok', (groups, expansions)), the man pages of groups are replaced by
+      their (name, position) in lookups since the caller already has them
+    - ('error', what _dumperror returned)
+    - ('missing', names), for names that weren't in lookups (such as nested
+      commands, which aren't known ahead of time)'''
+    refs = {}
+    for name, result in lookups.iteritems():
+        if isinstance(result, list):
+            for i, mp in enumerate(result):
+                refs[id(mp)] = (name, i)
+
+    s = _lookupstore(lookups)
+    results = []
+    for command in commands:
+        s.missing.clear()
+        m = matcher(command, s)
+        try:
+            groups = m.match()
+        except _batcherrors, e:
+            groups = None
+            error = _dumperror(e)
+
+        if s.missing:
+            results.append(('missing', sorted(s.missing)))
+        elif groups is None:
+            results.append(('error', error))
+        else:
+            for group in groups[1:]:
+                if group.manpage:
+                    group.manpage = refs[id(group.manpage)]
+                    group.suggestions = [refs[id(mp)] for mp in group.suggestions]
+            results.append(('ok', (groups, m.expansions)))
+    return results
+
+def _lookup(store, known, names):
+    '''look up the names that aren't in known in store, all at once'''
+    names = [name for name in names if name not in known]
+    if not names:
+        return
+    logger.info('looking up %d names', len(names))
+    for name, result in store.findmanpages(names).iteritems():
+        if isinstance(result, list):
+            # these are sent to the workers, which only need the options.
+            # the store's man pages may have texts that are loaded when
+            # they're used, and can't be pickled (those of a snapshot)
+            result = [mp.matchcopy() for mp in result]
+        known[name] = result
+
+def _matchwindow(pool, commands, store, known, chunksize):
+    results = [None] * len(commands)
+
+    # parse in the pool to find out which names need looking up
+    parsed = pool.map(_parsemany, list(util.chunks(commands, chunksize)))
+    pending = []
+    for i, (names, error) in enumerate(itertools.chain.from_iterable(parsed)):
+        if error:
+            results[i] = batchresult(commands[i], None, None, _loaderror(error))
+        else:
+            pending.append((i, names))
+
+    # commands that looked up names we didn't know about are matched again
+    # once we do
+    while pending:
+        _lookup(store, known, set(itertools.chain.from_iterable(names for i, names in pending)))
+        chunks = list(util.chunks(pending, chunksize))
+        tasks = []
+        for chunk in chunks:
+            lookups = {}
+            for i, names in chunk:
+                for name in names:
+                    lookups[name] = known[name]
+            tasks.append(([commands[i] for i, names in chunk], lookups))
+
+        retry = []
+        for chunk, chunkresults in zip(chunks, pool.map(_matchmany, tasks)):
+            for (i, names), (kind, value) in zip(chunk, chunkresults):
+                if kind == 'missing':
+                    retry.append((i, names + value))
+                elif kind == 'error':
+                    results[i] = batchresult(commands[i], None, None, _loaderror(value))
+                else:
+                    groups, expansions = value
+                    for group in groups[1:]:
+                        if group.manpage:
+                            name, j = group.manpage
+                            group.manpage = known[name][j]
+                            group.suggestions = [known[name][j] for name, j in group.suggestions]
+                    results[i] = batchresult(commands[i], groups, expansions, None)
+        pending = retry
+
+    return results
+
+def matchmany(commands, store, processes=None, chunksize=20):
+    '''match each of commands like matcher(command, store).match() does, on a
+    pool of processes (as many as there are cpus by default). every name is
+    looked up in store once for all of commands
+
+    commands are handled in windows of chunksize commands per process, yield a
+    batchresult for each of them in the order of commands. the error of a
+    batchresult is the ParsingError, ProgramDoesNotExist or
+    NotImplementedError matching the command raised'''
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        known = {}
+        for window in util.chunks(commands, chunksize * processes):
+            for result in _matchwindow(pool, window, store, known, chunksize):
+                yield result
+    finally:
+        pool.terminate()
@@ -19,6 +19,7 @@ def extract(manpage):
                 manpage.paragraphs[i] = store.option(p, s, l, expectsarg)
             else:
                 logger.error("no options could be extracted from paragraph %r", p)
+    manpage.invalidate()
 
 opt_regex = re.compile(r'''
     (?P<opt>--?(?:\?|\#|(?:\w+-)*\w+))  # option starts with - or -- and can have - in the middle but not at the end, also allow '-?'
@@ -0,0 +1,260 @@
+'''a read-only store that serves processed man pages from a snapshot file
+
+a snapshot is a single immutable file that contains everything the web tier
+needs from the manpage and mapping collections:
+
+    header - magic, format version and the offset/length of the index
+    blob - the text of the paragraphs of every man page followed by its
+           json document, where paragraph texts are (offset, length) pairs
+           into the blob. identical texts are written once
+    index - json with the name, source and summary of every man page and the
+            (offset, length) of its document, and the mappings
+
+the file is mmaped, so all processes that serve from the same snapshot share
+it through the page cache. a man page is decoded the first time it's looked
+up, and paragraph text is sliced out of the map only when it's accessed.
+'''
+import os, mmap, struct, json, functools, logging
+
+from explainshell import store, errors, util, config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'ESSNAP'
+VERSION = 2
+
+_header = struct.Struct('<6sHQQ')
+
+def write(path, manpages, mappings, generation=None):
+    '''write a snapshot to path
+
+    manpages is an iterable of (id, store.manpage), mappings is an iterable of
+    (src, id, score). ids are only used to connect the two and aren't kept in
+    the snapshot.
+
+    the snapshot is written with util.atomicwrite, so readers never see a
+    partial snapshot'''
+    ids = {}
+    entries = []
+    # text -> (offset, length) in the blob
+    texts = {}
+    with util.atomicwrite(path) as f:
+        f.write(_header.pack(MAGIC, VERSION, 0, 0))
+        offset = _header.size
+
+        for oid, m in manpages:
+            ids[oid] = len(entries)
+            d = m.to_store()
+            # unlike the store, a snapshot keeps options in place, slicing
+            # their text out of the map is what keeps prose from being read
+            for k in ('options', 'flags', 'arguments', 'version'):
+                del d[k]
+            pds = []
+            for p in m.paragraphs:
+                pd = p.to_store()
+                text = p.text
+                if isinstance(text, unicode):
+                    text = text.encode('utf8')
+                if text not in texts:
+                    f.write(text)
+                    texts[text] = (offset, len(text))
+                    offset += len(text)
+                pd['text'] = texts[text]
+                pds.append(pd)
+            d['paragraphs'] = pds
+
+            entry = {'name' : d['name'], 'source' : d['source'],
+                     'summary' : d.pop('summary')}
+            data = json.dumps(d)
+            f.write(data)
+            entry['at'] = (offset, len(data))
+            offset += len(data)
+            entries.append(entry)
+
+        l = []
+        for src, dst, score in mappings:
+            if dst not in ids:
+                logger.error('skipping mapping %r -> %r, no such manpage', src, dst)
+                continue
+            l.append((src, ids[dst], score))
+
+        index = json.dumps({'version' : VERSION, 'generation' : generation,
+                            'manpages' : entries, 'mappings' : l})
+        f.write(index)
+
+        f.seek(0)
+        f.write(_header.pack(MAGIC, VERSION, offset, len(index)))
+
+    logger.info('wrote snapshot %s with %d manpages and %d mappings',
+                path, len(entries), len(l))
+
+def export(s, path):
+    '''write the contents of store s to a snapshot at path'''
+    write(path, s.manpages(), s.mappingtuples(), s.generation())
+
+class snapshotstore(object):
+    '''serve man pages from the snapshot at path, answering lookups exactly
+    like store.store does'''
+    def __init__(self, path, cacheparagraphs=config.STORE_CACHE_PARAGRAPHS):
+        logger.info('opening snapshot %r', path)
+        self.path = path
+        with open(path, 'rb') as f:
+            # mmap refuses empty files, and the header has to be there
+            if os.fstat(f.fileno()).st_size < _header.size:
+                raise ValueError('%r is not a snapshot' % path)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, offset, length = _header.unpack(self._mm[:_header.size])
+            if magic != MAGIC:
+                raise ValueError('%r is not a snapshot' % path)
+            if version != VERSION:
+                raise ValueError('snapshot %r has version %d, expected %d' %
+                                 (path, version, VERSION))
+            if offset + length > len(self._mm):
+                raise ValueError('snapshot %r is truncated' % path)
+
+            index = json.loads(self._mm[offset:offset+length])
+        except:
+            self._mm.close()
+            raise
+        self._generation = index['generation']
+        # name, source, summary and the (offset, length) of the document of
+        # every man page, see _loadmanpage
+        self._entries = index['manpages']
+        self._bysource = dict((e['source'], i) for i, e in enumerate(self._entries))
+
+        # src -> [(dst, score)] and dst -> [src]
+        self._mappings = {}
+        self._srcs = {}
+        for src, dst, score in index['mappings']:
+            self._mappings.setdefault(src, []).append((dst, score))
+            self._srcs.setdefault(dst, []).append(src)
+
+        self._manpages = util.lrucache(cacheparagraphs,
+                                       weight=lambda m: len(m.paragraphs) + 1)
+        self._summaries = None
+
+    def close(self):
+        self._mm.close()
+
+    def ping(self):
+        try:
+            len(self._mm)
+        except ValueError:
+            # closed
+            return False
+        return True
+
+    def generation(self):
+        return self._generation
+
+    def cachekey(self):
+        return self.path, self._generation
+
+    def cachestats(self):
+        return {'manpages' : self._manpages.stats()}
+
+    def _slice(self, offset, length):
+        return self._mm[offset:offset+length]
+
+    def _paragraph(self, d):
+        text = functools.partial(self._slice, *d['text'])
+        p = store.paragraph(d.get('idx', 0), text, d['section'], d['is_option'])
+        if p.is_option == True and 'short' in d:
+            p = store.option(p, d['short'], d['long'], d['expectsarg'],
+                             d['argument'], d.get('nestedcommand'))
+        return p
+
+    def _loadmanpage(self, i):
+        try:
+            return self._manpages[i]
+        except KeyError:
+            d = json.loads(self._slice(*self._entries[i]['at']))
+            pds = d.pop('paragraphs')
+            m = store.manpage.from_store(d)
+            m.paragraphs = [self._paragraph(pd) for pd in pds]
+            self._manpages[i] = m
+            return m
+
+    def _nameonly(self, i):
+        e = self._entries[i]
+        return store.manpage.from_store_name_only(e['name'], e['source'])
+
+    def __contains__(self, name):
+        return name in self._mappings
+
+    def __iter__(self):
+        for i in range(len(self._entries)):
+            yield self._loadmanpage(i)
+
+    def findmanpage(self, name, explain=False):
+        '''see store.store.findmanpage, explain is ignored since paragraph text
+        is only read when it's accessed'''
+        if name.endswith('.gz'):
+            logger.info('name ends with .gz, looking up an exact match by source')
+            i = self._bysource.get(name)
+            if i is None:
+                raise errors.ProgramDoesNotExist(name)
+            m = self._loadmanpage(i)
+            logger.info('returning %s', m)
+            return [m]
+
+        origname = name
+        name, section = store.splitname(name)
+
+        logger.info('looking up manpage in mapping with src %r', name)
+        if name not in self._mappings:
+            raise errors.ProgramDoesNotExist(name)
+
+        dsts = dict(self._mappings[name])
+        # manpages are kept in the order they were read from the manpage
+        # collection, keep that order between equal scores like the store does
+        results = [(i, self._nameonly(i)) for i in sorted(dsts)]
+        results.sort(key=lambda x: dsts.get(x[0], 0), reverse=True)
+        logger.info('got %s', results)
+        if section is not None:
+            if len(results) > 1:
+                results.sort(key=lambda (i, m): m.section == section, reverse=True)
+                logger.info(r'sorting %r so %s is first', results, section)
+            if not results[0][1].section == section:
+                raise errors.ProgramDoesNotExist(origname)
+            results.extend(self._discovermanpagesuggestions(results[0][0], results))
+
+        i = results[0][0]
+        results = [x[1] for x in results]
+        results[0] = self._loadmanpage(i)
+        return results
+
+    def findmanpages(self, names, explain=False):
+        '''see store.store.findmanpages'''
+        results = {}
+        for name in names:
+            try:
+                results[name] = self.findmanpage(name)
+            except errors.ProgramDoesNotExist, e:
+                results[name] = e
+        return results
+
+    def _discovermanpagesuggestions(self, oid, existing):
+        '''see store.store._discovermanpagesuggestions'''
+        skip = set([i for i, m in existing])
+        suggestions = set()
+        for src in self._srcs.get(oid, []):
+            for dst, score in self._mappings[src]:
+                if dst not in skip:
+                    suggestions.add(dst)
+        return [(i, self._nameonly(i)) for i in sorted(suggestions)]
+
+    def summaries(self, skip=0, limit=0):
+        '''see store.store.summaries'''
+        if self._summaries is None:
+            l = [(e['name'], e['summary']) for e in self._entries]
+            l.sort(key=lambda (name, s): s['key'])
+            self._summaries = l
+        end = skip + limit if limit else None
+        return iter(self._summaries[skip:end])
+
+    def names(self):
+        for i, e in enumerate(self._entries):
+            yield i, e['name']
@@ -1,10 +1,106 @@
 '''data objects to save processed man pages to mongodb'''
-import pymongo, collections, re, logging
+import pymongo, pymongo.errors, collections, re, logging, os, threading, time, itertools, functools, hashlib, zlib
+import bisect
+import bson.binary, multiprocessing.pool
 
 from explainshell import errors, util, helpconstants, config
 
 logger = logging.getLogger(__name__)
 
+def splitname(name):
+    '''split name to its name and section, everything following the last dot
+    is taken as the section
+
+    >>> splitname('tar')
+    ('tar', None)
+    >>> splitname('tar.1')
+    ('tar', '1')
+    >>> splitname('.')
+    ('.', None)
+    '''
+    # don't try to look for a section if it's . (source)
+    if name != '.':
+        splitted = name.rsplit('.', 1)
+        if len(splitted) > 1:
+            return splitted[0], splitted[1]
+    return name, None
+
+_corpusname = re.compile(r'^\w+$')
+
+def texthash(text):
+    '''the key of text in the text collection
+
+    >>> texthash(u'foo') == texthash('foo')
+    True
+    '''
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return hashlib.sha1(text).hexdigest()
+
+class compressedtext(object):
+    '''zlib compressed text that is decompressed the first time it's called,
+    paragraphs accept it as their text
+
+    >>> t = compressedtext(zlib.compress('foo'))
+    >>> t() is t()
+    True
+    '''
+    __slots__ = ('_value',)
+
+    def __init__(self, data):
+        # a tuple until decompressed, so a single read tells which it is
+        self._value = (data,)
+
+    def __call__(self):
+        v = self._value
+        if isinstance(v, tuple):
+            v = self._value = zlib.decompress(v[0])
+        return v
+
+    def __len__(self):
+        v = self._value
+        if isinstance(v, tuple):
+            return len(v[0])
+        return len(v)
+
+    def peek(self):
+        '''the text, without keeping it decompressed'''
+        v = self._value
+        if isinstance(v, tuple):
+            return zlib.decompress(v[0])
+        return v
+
+    def compressed(self):
+        '''the compressed data, None once it's decompressed'''
+        v = self._value
+        if isinstance(v, tuple):
+            return v[0]
+
+    def copy(self):
+        '''a compressedtext of the same data that's decompressed on its own,
+        so this one stays compressed
+
+        >>> t = compressedtext(zlib.compress('foo'))
+        >>> t.copy()()
+        'foo'
+        >>> t.compressed() is not None
+        True
+        '''
+        v = self._value
+        if isinstance(v, tuple):
+            return compressedtext(v[0])
+        return self
+
+_interned = {}
+
+def _intern(s):
+    '''return a shared copy of s, used for strings that repeat across many
+    paragraphs such as section names and flags. unlike the builtin intern this
+    also works for unicode'''
+    if s is None:
+        return s
+    return _interned.setdefault(s, s)
+
 class classifiermanpage(collections.namedtuple('classifiermanpage', 'name paragraphs')):
     '''a man page that had its paragraphs manually tagged as containing options
     or not'''
@@ -18,13 +114,40 @@ class classifiermanpage(collections.namedtuple('classifiermanpage', 'name paragr
                 'paragraphs' : [p.to_store() for p in self.paragraphs]}
 
 class paragraph(object):
-    '''a paragraph inside a man page is text that ends with two new lines'''
+    '''a paragraph inside a man page is text that ends with two new lines
+
+    text may also be given as a function that returns it, in which case it is
+    called the first time text is accessed'''
+    __slots__ = ('idx', '_text', 'section', 'is_option')
+
+    # the attributes that are compared by __eq__
+    _fields = ('idx', 'text', 'section', 'is_option')
+
     def __init__(self, idx, text, section, is_option):
         self.idx = idx
-        self.text = text
-        self.section = section
+        self._text = text
+        self.section = _intern(section)
         self.is_option = is_option
 
+    @property
+    def text(self):
+        if callable(self._text):
+            self._text = self._text()
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+
+    def peektext(self):
+        '''the text, without keeping it if it has to be loaded'''
+        text = self._text
+        if isinstance(text, compressedtext):
+            return text.peek()
+        if callable(text):
+            return text()
+        return text
+
     def cleantext(self):
         t = re.sub(r'<[^>]+>', '', self.text)
         t = re.sub('&lt;', '<', t)
@@ -33,7 +156,10 @@ class paragraph(object):
 
     @staticmethod
     def from_store(d):
-        p = paragraph(d.get('idx', 0), d['text'].encode('utf8'), d['section'], d['is_option'])
+        text = d['text']
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
+        p = paragraph(d.get('idx', 0), text, d['section'], d['is_option'])
         return p
 
     def to_store(self):
@@ -48,22 +174,31 @@ class paragraph(object):
     def __eq__(self, other):
         if not other:
             return False
-        return self.__dict__ == other.__dict__
+        return self._state() == other._state()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _state(self):
+        return tuple(getattr(self, f) for f in self._fields)
 
 class option(paragraph):
     '''a paragraph that contains extracted options
 
-    short - a list of short options (-a, -b, ..)
-    long - a list of long options (--a, --b)
+    short - a tuple of short options (-a, -b, ..)
+    long - a tuple of long options (--a, --b)
     expectsarg - specifies if one of the short/long options expects an additional argument
     argument - specifies if to consider this as positional arguments
     nestedcommand - specifies if the arguments to this option can start a nested command
     '''
+    __slots__ = ('short', 'long', 'argument', 'expectsarg', 'nestedcommand')
+
+    _fields = paragraph._fields + __slots__
+
     def __init__(self, p, short, long, expectsarg, argument=None, nestedcommand=False):
-        paragraph.__init__(self, p.idx, p.text, p.section, p.is_option)
-        self.short = short
-        self.long = long
-        self._opts = self.short + self.long
+        paragraph.__init__(self, p.idx, p._text, p.section, p.is_option)
+        self.short = tuple(_intern(x) for x in short)
+        self.long = tuple(_intern(x) for x in long)
         self.argument = argument
         self.expectsarg = expectsarg
         self.nestedcommand = nestedcommand
@@ -72,7 +207,7 @@ class option(paragraph):
 
     @property
     def opts(self):
-        return self._opts
+        return self.short + self.long
 
     @classmethod
     def from_store(cls, d):
@@ -84,15 +219,16 @@ class option(paragraph):
     def to_store(self):
         d = paragraph.to_store(self)
         assert d['is_option']
-        d['short'] = self.short
-        d['long'] = self.long
+        d['short'] = list(self.short)
+        d['long'] = list(self.long)
         d['expectsarg'] = self.expectsarg
         d['argument'] = self.argument
         d['nestedcommand'] = self.nestedcommand
         return d
 
     def __str__(self):
-        return '(%s)' % ', '.join([str(x) for x in self.opts])
+        return '(%s)' % ', '.join([x.encode('utf8') if isinstance(x, unicode) else x
+                                   for x in self.opts])
 
     def __repr__(self):
         return '<options for paragraph %d: %s>' % (self.idx, str(self))
@@ -112,7 +248,15 @@ class manpage(object):
     updated - whether this man page was manually updated
     nestedcommand - specifies if positional arguments to this program can start a nested command,
         e.g. sudo, xargs
+
+    options, arguments and the flag -> option index used by find_option are
+    computed from paragraphs the first time they're needed. assigning paragraphs drops them,
+    changing paragraphs in place must be followed by invalidate()
     '''
+    __slots__ = ('source', 'name', 'synopsis', '_paragraphs', 'aliases',
+                 'partialmatch', 'multicommand', 'updated', 'nestedcommand',
+                 '_index')
+
     def __init__(self, source, name, synopsis, paragraphs, aliases,
                  partialmatch=False, multicommand=False, updated=False,
                  nestedcommand=False):
@@ -126,12 +270,37 @@ class manpage(object):
         self.updated = updated
         self.nestedcommand = nestedcommand
 
+    @property
+    def paragraphs(self):
+        return self._paragraphs
+
+    @paragraphs.setter
+    def paragraphs(self, paragraphs):
+        self._paragraphs = paragraphs
+        self._index = None
+
+    def invalidate(self):
+        '''drop everything computed from paragraphs'''
+        self._index = None
+
+    def _getindex(self):
+        index = self._index
+        if index is None:
+            options = [p for p in self.paragraphs if isinstance(p, option)]
+            flags = {}
+            for o in options:
+                for flag in o.opts:
+                    flags.setdefault(flag, o)
+            index = self._index = {'options' : options, 'flags' : flags}
+        return index
+
     def removeoption(self, idx):
-        for i, p in self.paragraphs:
+        for i, p in enumerate(self.paragraphs):
             if p.idx == idx:
                 if not isinstance(p, option):
                     raise ValueError("paragraph %d isn't an option" % idx)
                 self.paragraphs[i] = paragraph(p.idx, p.text, p.section, False)
+                self.invalidate()
                 return
         raise ValueError('idx %d not found' % idx)
 
@@ -147,14 +316,24 @@ class manpage(object):
 
     @property
     def options(self):
-        return [p for p in self.paragraphs if isinstance(p, option)]
+        '''the options in paragraphs, the list must not be modified'''
+        return self._getindex()['options']
 
     @property
     def arguments(self):
+        '''argument -> the text of the options that describe it, the dict must
+        not be modified'''
+        index = self._getindex()
+        if 'arguments' not in index:
+            index['arguments'] = self._groupbyargument(index['options'])
+        return index['arguments']
+
+    @staticmethod
+    def _groupbyargument(options):
         # go over all paragraphs and look for those with the same 'argument'
         # field
         groups = collections.OrderedDict()
-        for opt in self.options:
+        for opt in options:
             if opt.argument:
                 groups.setdefault(opt.argument, []).append(opt)
 
@@ -169,14 +348,60 @@ class manpage(object):
         return re.match(r'[\w|-]+ - (.*)$', self.synopsis).group(1)
 
     def find_option(self, flag):
-        for option in self.options:
-            for o in option.opts:
-                if o == flag:
-                    return option
+        return self._getindex()['flags'].get(flag)
+
+    def _flagindex(self):
+        '''flag -> the option it belongs to, or any other object that is the
+        same object for all the flags of an option'''
+        return self._getindex()['flags']
+
+    def complete_option(self, prefix):
+        '''resolve prefix as an abbreviation of a long flag, like getopt_long.
+        return (option, completions) where completions are the long flags that
+        start with prefix, and option is the option they all belong to, or None
+        if they belong to different options. if there are none, or the option
+        can't be loaded (see explainmanpage), completions is empty
+
+        the long flags are kept sorted in the index so completions are found
+        with a binary search'''
+        index = self._getindex()
+        flags = self._flagindex()
+        longs = index.get('longs')
+        if longs is None:
+            longs = index['longs'] = sorted(f for f in flags if f.startswith('--'))
+
+        completions = []
+        for i in xrange(bisect.bisect_left(longs, prefix), len(longs)):
+            if not longs[i].startswith(prefix):
+                break
+            completions.append(longs[i])
+
+        if completions:
+            first = flags[completions[0]]
+            if all(flags[f] is first for f in completions[1:]):
+                option = self.find_option(completions[0])
+                if option is None:
+                    return None, []
+                return option, completions
+        return None, completions
 
     def to_store(self):
+        # options are kept apart from the prose so they can be fetched without
+        # it, along with the position in options of every flag and of the
+        # options that describe positional arguments (see explainmanpage)
+        # version identifies the options, options loaded one at a time are
+        # fetched from the version their position was taken from
+        options = [p for p in self.paragraphs if isinstance(p, option)]
+        optiondocs = [o.to_store() for o in options]
         return {'source' : self.source, 'name' : self.name, 'synopsis' : self.synopsis,
-                'paragraphs' : [p.to_store() for p in self.paragraphs],
+                'paragraphs' : [p.to_store() for p in self.paragraphs
+                                if not isinstance(p, option)],
+                'options' : optiondocs,
+                'version' : hashlib.sha1(bson.BSON.encode({'options' : optiondocs})).hexdigest(),
+                'flags' : [[flag, i] for i, o in enumerate(options) for flag in o.opts],
+                'arguments' : [i for i, o in enumerate(options) if o.argument],
+                'summary' : summary(self.name, self.synopsis,
+                                    [(o.short, o.long) for o in options]),
                 'aliases' : self.aliases, 'partialmatch' : self.partialmatch,
                 'multicommand' : self.multicommand, 'updated' : self.updated,
                 'nestedcommand' : self.nestedcommand}
@@ -189,6 +414,11 @@ class manpage(object):
             if pp.is_option == True and 'short' in pd:
                 pp = option.from_store(pd)
             paragraphs.append(pp)
+        options = [option.from_store(pd) for pd in d.get('options', [])]
+        if paragraphs and options:
+            paragraphs = sorted(paragraphs + options, key=lambda p: p.idx)
+        else:
+            paragraphs.extend(options)
 
         synopsis = d['synopsis']
         if synopsis:
@@ -200,6 +430,17 @@ class manpage(object):
                        [tuple(x) for x in d['aliases']], d['partialmatch'],
                        d['multicommand'], d['updated'], d.get('nestedcommand'))
 
+    def matchcopy(self):
+        '''a copy with just what the matcher needs: the options, with their
+        text in place so the copy can be pickled, and none of the prose.
+        loading the text of self's options is left for when they're used'''
+        options = [option(paragraph(o.idx, o.peektext(), o.section, o.is_option),
+                          o.short, o.long, o.expectsarg, o.argument, o.nestedcommand)
+                   for o in self.options]
+        return manpage(self.source, self.name, self.synopsis, options, self.aliases,
+                       self.partialmatch, self.multicommand, self.updated,
+                       self.nestedcommand)
+
     @staticmethod
     def from_store_name_only(name, source):
         return manpage(source, name, None, [], [], None, None, None)
@@ -207,33 +448,463 @@ class manpage(object):
     def __repr__(self):
         return '<manpage %r(%s), %d options>' % (self.name, self.section, len(self.options))
 
+def summary(name, synopsis, options):
+    '''the summary of a man page listed by the debug view, options is a list of
+    (short, long) for its options. key is what summaries are sorted by
+
+    >>> sorted(summary('Foo', 'foo synopsis', [(['-a'], ['--all'])]).items())
+    [('key', 'foo'), ('options', '(-a, --all)'), ('synopsis', 'foo synopsis')]
+    '''
+    return {'key' : name.lower(), 'synopsis' : (synopsis or '')[:20],
+            'options' : ', '.join('(%s)' % ', '.join(list(short) + list(long))
+                                  for short, long in options)}
+
+class explainmanpage(manpage):
+    '''the parts of a man page that are needed to explain a command line: it
+    has no prose paragraphs, and only the options that came with the document
+    it was created from (see _explainfields). the rest are loaded one at a
+    time by loadoption(position) when find_option or arguments need them.
+    loadoption returns None if the man page changed since, and the option
+    is treated as unknown
+
+    paragraphs and options contain only the loaded options'''
+    __slots__ = ('_flags', '_arguments', '_loaded', '_loadoption')
+
+    @staticmethod
+    def from_store(d, loadoption):
+        m = manpage.from_store(d)
+        e = explainmanpage(m.source, m.name, m.synopsis, m.paragraphs, m.aliases,
+                           m.partialmatch, m.multicommand, m.updated, m.nestedcommand)
+        e._flags = {}
+        # the flags of an option share one position object, see _flagindex
+        positions = {}
+        for flag, i in d['flags']:
+            e._flags.setdefault(_intern(flag), positions.setdefault(i, i))
+        e._arguments = d['arguments']
+        e._loaded = dict(enumerate(m.paragraphs))
+        e._loadoption = loadoption
+        return e
+
+    def _option(self, i):
+        o = self._loaded.get(i)
+        if o is None:
+            o = self._loadoption(i)
+            if o is not None:
+                self._loaded[i] = o
+        return o
+
+    def find_option(self, flag):
+        i = self._flags.get(flag)
+        if i is not None:
+            return self._option(i)
+
+    def _flagindex(self):
+        return self._flags
+
+    @property
+    def arguments(self):
+        index = self._getindex()
+        if 'arguments' not in index:
+            options = [self._option(i) for i in self._arguments]
+            index['arguments'] = self._groupbyargument([o for o in options if o])
+        return index['arguments']
+
+def _texthashes(d):
+    '''the hashes of the texts of manpage document d'''
+    return set(pd['hash'] for pd in itertools.chain(d.get('paragraphs', ()),
+                                                    d.get('options', ())))
+
+def _explainfields():
+    '''the projection of a manpage document that explainmanpage is created
+    from'''
+    return {'paragraphs' : 0, 'options' : {'$slice' : config.STORE_EXPLAIN_OPTIONS}}
+
 class store(object):
     '''read/write processed man pages from mongodb
 
-    we use three collections:
+    we use six collections:
     1) classifier - contains manually tagged paragraphs from man pages
     2) manpage - contains a processed man page
     3) mapping - contains (name, manpageid, score) tuples
+    4) lookup - a denormalized view of mapping and manpage, keyed by name.
+       each document has the candidates for its name, ordered by score, and
+       the explain view (see explainmanpage) of the manpage document of the
+       first one with the hashes of its texts, so explaining a command
+       resolves a name with one query (and one to text for texts that aren't
+       cached).
+       it's kept up to date by every method that writes to mapping or
+       manpage
+    5) text - contains the text of paragraphs keyed by its sha1 (see
+       texthash). the paragraphs in manpage have the hash of their text
+       instead of the text, so text that repeats across man pages (license
+       boilerplate, pages installed in several sections) is stored once.
+       texts are stored zlib compressed when compresstext is set (see
+       config.STORE_COMPRESS_TEXT) and decompressed when they're accessed.
+       texts that replaced man pages no longer use are removed (see
+       sweeptexts)
+    6) meta - contains the generation of the corpus, which is bumped on every
+       write to manpage or mapping, the schema version of the db (see
+       MIGRATIONS) and the name of the active corpus
+
+    manpage, mapping, lookup and text make up a corpus. besides the default corpus
+    (named '', its collections have no prefix) the db can hold named corpora
+    whose collections are prefixed by '<name>.' and whose meta documents are
+    suffixed by '.<name>'. a full rebuild writes into a fresh corpus while the
+    site keeps reading the active one, and then activate() switches over with
+    a single write to meta. stores created without a corpus use the one that
+    is active when they're created, and if follow is set they switch to
+    whichever corpus becomes active later (shared readers do that, writers
+    must stay in the corpus they started writing to). the corpus that was
+    active before is left untouched so rollback() can switch back to it
+
+    lookups done by findmanpage are cached in memory until the generation
+    changes. we also keep the set of all names in lookup in memory, so names
+    that can't match anything never cost a query
     '''
-    def __init__(self, db='explainshell', host=config.MONGO_URI):
+    def __init__(self, db='explainshell', host=config.MONGO_URI, corpus=None,
+                 follow=False, cachelookups=config.STORE_CACHE_LOOKUPS,
+                 cacheparagraphs=config.STORE_CACHE_PARAGRAPHS,
+                 cachetexts=config.STORE_CACHE_TEXTS,
+                 compresstext=config.STORE_COMPRESS_TEXT, **clientoptions):
         logger.info('creating store, db = %r, host = %r', db, host)
-        self.connection = pymongo.MongoClient(host)
+        self.connection = pymongo.MongoClient(host, **clientoptions)
         self.db = self.connection[db]
         self.classifier = self.db['classifier']
-        self.manpage = self.db['manpage']
-        self.mapping = self.db['mapping']
+        self.meta = self.db['meta']
+
+        # name -> (id of the first man page, list of man pages with only their
+        # name and source) or the ProgramDoesNotExist raised for it
+        self._lookups = util.lrucache(cachelookups)
+        # manpage id -> decoded manpage, weighted by its number of paragraphs
+        self._manpages = util.lrucache(cacheparagraphs,
+                                       weight=lambda m: len(m.paragraphs) + 1)
+        # manpage id -> explainmanpage
+        self._explains = util.lrucache(cacheparagraphs,
+                                       weight=lambda m: len(m.paragraphs) + 1)
+        # text hash -> text, weighted by its length. compressed texts stay
+        # compressed in here, callers get a copy (see _loadtexts). texts never
+        # change so this isn't dropped with the other caches
+        self._texts = util.lrucache(cachetexts, weight=len)
+        self.compresstext = compresstext
+        self._generation = None
+        self._generationchecked = 0
+
+        # the _ids of lookup, loaded on first use. unlike the caches, writes
+        # made through this store update it instead of dropping it
+        self._directory = None
+        self._directorystats = {'known' : 0, 'unknown' : 0}
+
+        # without a corpus we use the active one, and if follow is set keep
+        # following it, see _checkgeneration
+        self._follow = corpus is None and follow
+        if corpus is None:
+            try:
+                corpus = self.activecorpus()
+            except:
+                self.connection.disconnect()
+                raise
+        self._usecorpus(corpus)
+
+    def _usecorpus(self, corpus):
+        if corpus and not _corpusname.match(corpus):
+            raise ValueError('invalid corpus name %r' % corpus)
+        self.corpus = corpus
+        self.manpage = self.db[self._collectionname('manpage')]
+        self.mapping = self.db[self._collectionname('mapping')]
+        self.lookup = self.db[self._collectionname('lookup')]
+        self.text = self.db[self._collectionname('text')]
+        self._generation = None
+        self._invalidate()
+
+    def _collectionname(self, name):
+        if self.corpus:
+            return '%s.%s' % (self.corpus, name)
+        return name
+
+    def _metaid(self, name):
+        if self.corpus:
+            return '%s.%s' % (name, self.corpus)
+        return name
+
+    def activecorpus(self):
+        '''return the name of the corpus that readers are served from'''
+        d = self.meta.find_one({'_id' : 'corpus'})
+        if d:
+            return d['active']
+        return ''
+
+    def _switchcorpus(self, expected, corpus):
+        '''make corpus the active one if expected is still active, keeping
+        expected as the previous corpus. return False if somebody else
+        switched first'''
+        if self.meta.find_one({'_id' : 'corpus'}) is None:
+            try:
+                self.meta.insert({'_id' : 'corpus', 'active' : ''})
+            except pymongo.errors.DuplicateKeyError:
+                pass
+        r = self.meta.update({'_id' : 'corpus', 'active' : expected},
+                             {'$set' : {'active' : corpus, 'previous' : expected}})
+        return r['n'] == 1
+
+    def activate(self):
+        '''make our corpus the one readers are served from and return the
+        corpus that was active before
+
+        the switch is a single write to meta, readers pick it up the next time
+        they check the generation'''
+        self.checkschema()
+        while True:
+            previous = self.activecorpus()
+            if previous == self.corpus or self._switchcorpus(previous, self.corpus):
+                break
+        logger.info('activated corpus %r, previous corpus was %r', self.corpus, previous)
+        return previous
+
+    def rollback(self):
+        '''switch readers back to the corpus that was active before the last
+        activate() and return its name'''
+        while True:
+            d = self.meta.find_one({'_id' : 'corpus'})
+            if not d or 'previous' not in d:
+                raise ValueError('there is no previous corpus to roll back to')
+            if self._switchcorpus(d['active'], d['previous']):
+                break
+        logger.info('rolled back to corpus %r from %r', d['previous'], d['active'])
+        return d['previous']
 
     def close(self):
         self.connection.disconnect()
-        self.classifier = self.manpage = self.mapping = self.db = None
+        self.classifier = self.manpage = self.mapping = self.lookup = self.text = self.db = None
+
+    def ping(self):
+        '''return True if the server answered a ping within the configured
+        timeouts'''
+        try:
+            self.connection.admin.command('ping')
+            return True
+        except pymongo.errors.PyMongoError, e:
+            logger.error('ping to %r failed: %s', self.db.name, e)
+            return False
 
     def drop(self, confirm=False):
         if not confirm:
             return
 
-        logger.info('dropping mapping, manpage, collections')
+        logger.info('dropping mapping, manpage, lookup, text collections of corpus %r', self.corpus)
         self.mapping.drop()
         self.manpage.drop()
+        self.lookup.drop()
+        self.text.drop()
+        self._directory = None
+        # indexes went away with the collections
+        self.meta.remove({'_id' : self._metaid('schema')})
+        self._bumpgeneration()
+
+    def schemaversion(self):
+        d = self.meta.find_one({'_id' : self._metaid('schema')})
+        if d:
+            return d['version']
+        return 0
+
+    def checkschema(self):
+        '''raise SchemaOutdated unless all migrations were applied to the db'''
+        version = self.schemaversion()
+        if version != SCHEMAVERSION:
+            raise errors.SchemaOutdated('corpus %r of db %r has schema version %d, '
+                                        'expected %d (run manager.py --migrate)' %
+                                        (self.corpus, self.db.name, version, SCHEMAVERSION))
+
+    def migrate(self):
+        '''apply all migrations the db hasn't seen yet, return the number of
+        applied migrations'''
+        version = self.schemaversion()
+        if version > SCHEMAVERSION:
+            raise errors.SchemaOutdated('db %r has schema version %d, newer than %d' %
+                                        (self.db.name, version, SCHEMAVERSION))
+
+        for i, (description, fn) in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info('migrating %s to schema version %d: %s', self.db.name, i, description)
+            fn(self)
+            self.meta.update({'_id' : self._metaid('schema')}, {'$set' : {'version' : i}},
+                             upsert=True)
+        return SCHEMAVERSION - version
+
+    def _createindexes(self):
+        # the projections on mapping are covered by these
+        self.mapping.create_index([('src', pymongo.ASCENDING),
+                                   ('dst', pymongo.ASCENDING),
+                                   ('score', pymongo.ASCENDING)])
+        self.mapping.create_index([('dst', pymongo.ASCENDING),
+                                   ('src', pymongo.ASCENDING)])
+        self.manpage.create_index('source')
+        self.manpage.create_index('name')
+        self._createlookupindexes(self.lookup)
+
+    def _summarize(self):
+        '''add the summary to manpage documents from before it was kept'''
+        cursor = self.manpage.find({'summary' : {'$exists' : False}},
+                                   {'name' : 1, 'synopsis' : 1,
+                                    'options.short' : 1, 'options.long' : 1})
+        for d in cursor:
+            s = summary(d['name'], d['synopsis'],
+                        [(o['short'], o['long']) for o in d.get('options', [])])
+            self.manpage.update({'_id' : d['_id']}, {'$set' : {'summary' : s}})
+        self.manpage.create_index('summary.key')
+
+    def _splitparagraphs(self):
+        '''rewrite manpage documents from before options were kept apart from
+        prose paragraphs'''
+        cursor = self.manpage.find({'options' : {'$exists' : False}})
+        for n, d in enumerate(cursor, 1):
+            nd = manpage.from_store(d).to_store()
+            self.manpage.update({'_id' : d['_id']},
+                                {'$set' : dict((k, nd[k]) for k in
+                                               ('paragraphs', 'options', 'flags', 'arguments',
+                                                'version'))})
+            if n % 1000 == 0:
+                logger.info('rewrote %d manpages', n)
+        self._bumpgeneration()
+
+    def textstats(self):
+        '''yield (source, size, storedsize, seconds) for every man page: the
+        size of the text of its paragraphs, the size it takes in the text
+        collection and the time it takes to decompress it'''
+        cursor = self.manpage.find(fields={'source' : 1, 'paragraphs.hash' : 1,
+                                           'options.hash' : 1})
+        for docs in util.chunks(cursor, 100):
+            hashes = set(pd['hash'] for d in docs
+                         for pd in itertools.chain(d['paragraphs'], d['options']))
+            texts = dict((x['_id'], x) for x in self.text.find({'_id' : {'$in' : list(hashes)}}))
+            for d in docs:
+                size = stored = 0
+                seconds = 0.0
+                for pd in itertools.chain(d['paragraphs'], d['options']):
+                    x = texts.get(pd['hash'])
+                    if x is None:
+                        continue
+                    if 'zlib' in x:
+                        start = time.time()
+                        size += len(zlib.decompress(x['zlib']))
+                        seconds += time.time() - start
+                        stored += len(x['zlib'])
+                    else:
+                        n = len(x['text'].encode('utf8'))
+                        size += n
+                        stored += n
+                yield d['source'], size, stored, seconds
+
+    def _hashtexts(self):
+        '''move the text of paragraphs of existing manpage documents to the text
+        collection'''
+        cursor = self.manpage.find({'$or' : [{'paragraphs.text' : {'$exists' : True}},
+                                             {'options.text' : {'$exists' : True}}]},
+                                   {'paragraphs' : 1, 'options' : 1})
+        n = 0
+        for docs in util.chunks(cursor, 100):
+            self._storetexts(docs)
+            for d in docs:
+                self.manpage.update({'_id' : d['_id']},
+                                    {'$set' : {'paragraphs' : d['paragraphs'],
+                                               'options' : d['options']}})
+            n += len(docs)
+            logger.info('moved the text of %d manpages', n)
+        self._bumpgeneration()
+
+    def _uniquesources(self):
+        '''remove man pages that were added twice under the same source,
+        keeping the latest one, and make source unique'''
+        seen = {}
+        dups = []
+        for d in self.manpage.find({}, {'source' : 1}).sort('_id', pymongo.ASCENDING):
+            if d['source'] in seen:
+                dups.append(seen[d['source']])
+            seen[d['source']] = d['_id']
+        if dups:
+            logger.info('removing %d duplicate manpages', len(dups))
+            srcs = self.mapping.find({'dst' : {'$in' : dups}}).distinct('src')
+            self.mapping.remove({'dst' : {'$in' : dups}})
+            self.manpage.remove({'_id' : {'$in' : dups}})
+            self._refreshlookup(srcs)
+            self._bumpgeneration()
+        self.manpage.drop_index('source_1')
+        self.manpage.create_index('source', unique=True)
+
+    def _createlookupindexes(self, collection):
+        collection.create_index('candidates._id')
+
+    def generation(self):
+        '''return the current generation of the corpus'''
+        d = self.meta.find_one({'_id' : self._metaid('generation')})
+        if d:
+            return d['value']
+        return 0
+
+    def _bumpgeneration(self):
+        d = self.meta.find_and_modify({'_id' : self._metaid('generation')},
+                                      {'$inc' : {'value' : 1}}, upsert=True, new=True)
+        # if nobody else wrote since we last looked, our directory is still
+        # up to date
+        ours = self._generation is not None and d['value'] == self._generation + 1
+        self._invalidate(directory=not ours)
+        self._generation = d['value']
+
+    def _invalidate(self, directory=True):
+        self._lookups.clear()
+        self._manpages.clear()
+        self._explains.clear()
+        if directory:
+            self._directory = None
+
+    def _checkgeneration(self):
+        '''drop the caches if somebody else changed the corpus since we last
+        looked'''
+        now = time.time()
+        if now - self._generationchecked < config.STORE_GENERATION_INTERVAL:
+            return
+        self._generationchecked = now
+
+        if self._follow:
+            corpus = self.activecorpus()
+            if corpus != self.corpus:
+                logger.info('active corpus changed %r -> %r, switching to it',
+                            self.corpus, corpus)
+                self._usecorpus(corpus)
+
+        generation = self.generation()
+        if generation != self._generation:
+            if self._generation is not None:
+                logger.info('generation changed %r -> %r, dropping caches',
+                            self._generation, generation)
+            self._invalidate()
+            self._generation = generation
+
+    def cachekey(self):
+        '''identify what the corpus contained when the generation was last
+        checked, for caches of things computed from it that are kept outside
+        of the store'''
+        self._checkgeneration()
+        return self.corpus, self._generation
+
+    def cachestats(self):
+        directory = dict(self._directorystats)
+        directory['size'] = len(self._directory or ())
+        return {'lookups' : self._lookups.stats(),
+                'manpages' : self._manpages.stats(),
+                'explains' : self._explains.stats(),
+                'texts' : self._texts.stats(),
+                'directory' : directory}
+
+    def _known(self, name):
+        '''return False if name (without a section) is certainly not in
+        lookup'''
+        if self._directory is None:
+            logger.info('loading names directory')
+            self._directory = set(d['_id'] for d in self.lookup.find({}, {'_id' : 1}))
+        if name in self._directory:
+            self._directorystats['known'] += 1
+            return True
+        self._directorystats['unknown'] += 1
+        return False
 
     def trainingset(self):
         for d in self.classifier.find():
@@ -244,61 +915,283 @@ class store(object):
         return c > 0
 
     def __iter__(self):
-        for d in self.manpage.find():
-            yield manpage.from_store(d)
+        for _id, m in self.manpages():
+            yield m
+
+    def manpages(self):
+        '''yield (id, manpage) for all man pages'''
+        for docs in util.chunks(self.manpage.find(), 100):
+            self._loadtexts(docs)
+            for d in docs:
+                yield d['_id'], manpage.from_store(d)
+
+    def mappingtuples(self):
+        '''yield (src, dst, score) for all mappings'''
+        for d in self.mapping.find({}, {'_id' : 0, 'src' : 1, 'dst' : 1, 'score' : 1}):
+            yield d['src'], d['dst'], d['score']
+
+    def summaries(self, skip=0, limit=0):
+        '''yield the name and summary (see summary) of man pages sorted by
+        name, skipping the first skip and stopping after limit'''
+        cursor = self.manpage.find(fields={'_id' : 0, 'name' : 1, 'summary' : 1},
+                                   sort=[('summary.key', pymongo.ASCENDING)],
+                                   skip=skip, limit=limit)
+        for d in cursor:
+            yield d['name'], d['summary']
+
+    def bulkinsert(self, manpages=(), mappings=()):
+        '''insert manpage documents (with their text in place) and mapping
+        documents as they are. lookup and the generation aren't kept up to
+        date, this is meant for loading into an empty corpus that's migrated
+        afterwards (see dump.load)'''
+        manpages = list(manpages)
+        if manpages:
+            self._storetexts(manpages)
+            self.manpage.insert(manpages)
+        mappings = list(mappings)
+        if mappings:
+            self.mapping.insert(mappings)
+
+    def _storetexts(self, docs):
+        '''replace the text of the paragraphs of manpage documents docs by its
+        hash, and add the texts that aren't in the text collection'''
+        texts = {}
+        for d in docs:
+            for pd in itertools.chain(d['paragraphs'], d['options']):
+                if 'text' in pd:
+                    text = pd.pop('text')
+                    pd['hash'] = h = texthash(text)
+                    texts[h] = text
+        if not texts:
+            return
 
-    def findmanpage(self, name):
+        cursor = self.text.find({'_id' : {'$in' : list(texts)}}, {'_id' : 1})
+        existing = set(x['_id'] for x in cursor)
+        new = [self._textdoc(h, text) for h, text in texts.iteritems()
+               if h not in existing]
+        logger.info('storing %d new texts out of %d', len(new), len(texts))
+        if new:
+            try:
+                self.text.insert(new, continue_on_error=True)
+            except pymongo.errors.DuplicateKeyError:
+                # somebody else stored some of them since we looked
+                pass
+
+    def _textdoc(self, h, text):
+        if self.compresstext:
+            data = text
+            if isinstance(data, unicode):
+                data = data.encode('utf8')
+            if len(data) >= self.compresstext:
+                z = zlib.compress(data)
+                if len(z) < len(data):
+                    return {'_id' : h, 'zlib' : bson.binary.Binary(z)}
+        return {'_id' : h, 'text' : text}
+
+    def _loadtexts(self, docs):
+        '''put the text back into the paragraphs of manpage documents docs that
+        have a hash instead. identical texts are the same string, compressed
+        texts are decompressed when they're accessed (see compressedtext)'''
+        pds = [pd for d in docs
+               for pd in itertools.chain(d.get('paragraphs', ()), d.get('options', ()))
+               if 'hash' in pd]
+        texts = {}
+        for pd in pds:
+            h = pd['hash']
+            if h not in texts:
+                try:
+                    texts[h] = self._texts[h]
+                except KeyError:
+                    texts[h] = None
+
+        missing = [h for h, text in texts.iteritems() if text is None]
+        if missing:
+            for x in self.text.find({'_id' : {'$in' : missing}}):
+                if 'zlib' in x:
+                    text = compressedtext(x['zlib'])
+                else:
+                    text = x['text'].encode('utf8')
+                texts[x['_id']] = self._texts[x['_id']] = text
+
+        for h, text in texts.iteritems():
+            if text is None:
+                logger.error('text %s is missing from the text collection', h)
+                texts[h] = ''
+            elif isinstance(text, compressedtext):
+                # the cached one is never decompressed, so it keeps its weight
+                texts[h] = text.copy()
+
+        for pd in pds:
+            pd['text'] = texts[pd.pop('hash')]
+
+    def findmanpage(self, name, explain=False):
         '''find a man page by its name, everything following the last dot (.) in name,
         is taken as the section of the man page
 
         we return the man page found with the highest score, and a list of
         suggestions that also matched the given name (only the first item
-        is prepopulated with the option data)'''
+        is prepopulated with the option data)
+
+        if explain is True the first man page is an explainmanpage, which has
+        only what's needed to explain a command line with it
+
+        the returned man pages may be shared with other callers and must not
+        be modified'''
+        self._checkgeneration()
+        results = self._lookup(name)
+        if isinstance(results, errors.ProgramDoesNotExist):
+            raise results
+        return self._complete(results, explain)
+
+    def findmanpages(self, names, explain=False):
+        '''look up several names at once, return a dict mapping every name to
+        the list findmanpage would return for it, or to the ProgramDoesNotExist
+        it would raise
+
+        names that aren't cached are resolved with a single query'''
+        self._checkgeneration()
+        results = {}
+        missing = collections.defaultdict(list)
+        for name in set(names):
+            try:
+                results[name] = self._lookups[name]
+            except KeyError:
+                if name.endswith('.gz'):
+                    # rare, not worth batching
+                    results[name] = self._lookup(name)
+                else:
+                    basename, section = splitname(name)
+                    if self._known(basename):
+                        missing[basename].append((name, section))
+                    else:
+                        results[name] = errors.ProgramDoesNotExist(basename)
+
+        if missing:
+            logger.info('looking up %d names in lookup', len(missing))
+            cursor = self.lookup.find({'_id' : {'$in' : list(missing)}})
+            docs = dict((d['_id'], d) for d in cursor)
+            for basename, l in missing.iteritems():
+                for name, section in l:
+                    try:
+                        r = self._resolve(basename, section, docs.get(basename))
+                    except errors.ProgramDoesNotExist, e:
+                        r = e
+                    self._lookups[name] = results[name] = r
+
+        for name, r in results.iteritems():
+            if not isinstance(r, errors.ProgramDoesNotExist):
+                results[name] = self._complete(r, explain)
+        return results
+
+    def _lookup(self, name):
+        '''return what _findmanpage returns for name, or the ProgramDoesNotExist
+        it raises, through the cache'''
+        if not name.endswith('.gz'):
+            basename = splitname(name)[0]
+            if not self._known(basename):
+                return errors.ProgramDoesNotExist(basename)
+        try:
+            return self._lookups[name]
+        except KeyError:
+            try:
+                results = self._findmanpage(name)
+            except errors.ProgramDoesNotExist, e:
+                results = e
+            self._lookups[name] = results
+            return results
+
+    def _complete(self, results, explain):
+        '''turn (oid, results) into the list findmanpage returns'''
+        oid, results = results
+        results = list(results)
+        if explain:
+            results[0] = self._loadexplain(oid)
+        else:
+            results[0] = self._loadmanpage(oid)
+        return results
+
+    def _loadmanpage(self, oid):
+        try:
+            return self._manpages[oid]
+        except KeyError:
+            d = self.manpage.find_one({'_id' : oid})
+            self._loadtexts([d])
+            m = manpage.from_store(d)
+            self._manpages[oid] = m
+            return m
+
+    def _loadexplain(self, oid, d=None):
+        '''return the explainmanpage of oid, created from d if it's not cached
+        and d is given'''
+        try:
+            return self._explains[oid]
+        except KeyError:
+            if d is None:
+                d = self.manpage.find_one({'_id' : oid}, _explainfields())
+            self._loadtexts([d])
+            m = explainmanpage.from_store(d, functools.partial(self._loadoption, oid,
+                                                               d.get('version')))
+            self._explains[oid] = m
+            return m
+
+    def _loadoption(self, oid, version, i):
+        '''load the option at position i of version of manpage oid, return
+        None if the man page was rewritten since'''
+        logger.info('loading option %d of manpage %s', i, oid)
+        d = self.manpage.find_one({'_id' : oid, 'version' : version},
+                                  {'_id' : 0, 'paragraphs' : 0, 'flags' : 0,
+                                   'options' : {'$slice' : [i, 1]}})
+        if not d or not d['options']:
+            # the caches are dropped once the generation check notices, until
+            # then drop what we have of this man page so it's loaded again
+            logger.info('manpage %s changed since version %s', oid, version)
+            self._explains.discard(oid)
+            self._manpages.discard(oid)
+            return None
+        self._loadtexts([d])
+        return option.from_store(d['options'][0])
+
+    def _findmanpage(self, name):
+        '''return (oid, results) where results are the man pages findmanpage
+        returns for name with only their name and source, and oid is the id
+        of the first one'''
         if name.endswith('.gz'):
             logger.info('name ends with .gz, looking up an exact match by source')
             d = self.manpage.find_one({'source':name})
             if not d:
                 raise errors.ProgramDoesNotExist(name)
+            self._loadtexts([d])
             m = manpage.from_store(d)
+            self._manpages[d['_id']] = m
             logger.info('returning %s', m)
-            return [m]
-
-        section = None
-        origname = name
-
-        # don't try to look for a section if it's . (source)
-        if name != '.':
-            splitted = name.rsplit('.', 1)
-            name = splitted[0]
-            if len(splitted) > 1:
-                section = splitted[1]
-
-        logger.info('looking up manpage in mapping with src %r', name)
-        cursor = self.mapping.find({'src' : name})
-        count = cursor.count()
-        if not count:
+            return d['_id'], [manpage.from_store_name_only(m.name, m.source)]
+
+        name, section = splitname(name)
+        logger.info('looking up manpage in lookup with name %r', name)
+        return self._resolve(name, section, self.lookup.find_one({'_id' : name}))
+
+    def _resolve(self, name, section, d):
+        '''return what _findmanpage returns for name and section from d, the
+        lookup document of name (None if there isn't one)'''
+        if not d:
             raise errors.ProgramDoesNotExist(name)
 
-        dsts = dict(((d['dst'], d['score']) for d in cursor))
-        cursor = self.manpage.find({'_id' : {'$in' : list(dsts.keys())}}, {'name' : 1, 'source' : 1})
-        if cursor.count() != len(dsts):
-            logger.error('one of %r mappings is missing in manpage collection '
-                         '(%d mappings, %d found)', dsts, len(dsts), cursor.count())
-        results = [(d.pop('_id'), manpage.from_store_name_only(**d)) for d in cursor]
-        results.sort(key=lambda x: dsts.get(x[0], 0), reverse=True)
+        results = [(c['_id'], manpage.from_store_name_only(c['name'], c['source']))
+                   for c in d['candidates']]
         logger.info('got %s', results)
         if section is not None:
             if len(results) > 1:
                 results.sort(key=lambda (oid, m): m.section == section, reverse=True)
                 logger.info(r'sorting %r so %s is first', results, section)
             if not results[0][1].section == section:
-                raise errors.ProgramDoesNotExist(origname)
+                raise errors.ProgramDoesNotExist('%s.%s' % (name, section))
             results.extend(self._discovermanpagesuggestions(results[0][0], results))
 
         oid = results[0][0]
-        results = [x[1] for x in results]
-        results[0] = manpage.from_store(self.manpage.find_one({'_id' : oid}))
-        return results
+        if oid == d['manpage']['_id']:
+            # lookup has the explain view of the default man page for name
+            self._loadexplain(oid, d['manpage'])
+        return oid, [x[1] for x in results]
 
     def _discovermanpagesuggestions(self, oid, existing):
         '''find suggestions for a given man page
@@ -308,81 +1201,325 @@ class store(object):
         already discovered
         '''
         skip = set([oid for oid, m in existing])
-        cursor = self.mapping.find({'dst' : oid})
-        # find all srcs that point to oid
-        srcs = [d['src'] for d in cursor]
-        # find all dsts of srcs
-        suggestionoids = self.mapping.find({'src' : {'$in' : srcs}}, {'dst' : 1})
-        # remove already discovered
-        suggestionoids = [d['dst'] for d in suggestionoids if d['dst'] not in skip]
-        if not suggestionoids:
-            return []
-
-        # get just the name and source of found suggestions
-        suggestionoids = self.manpage.find({'_id' : {'$in' : suggestionoids}},
-                                           {'name' : 1, 'source' : 1})
-        return [(d.pop('_id'), manpage.from_store_name_only(**d)) for d in suggestionoids]
+        # find all names that point to oid, their candidates are the
+        # suggestions
+        cursor = self.lookup.find({'candidates._id' : oid}, {'candidates' : 1})
+        suggestions = {}
+        for d in cursor:
+            for c in d['candidates']:
+                if c['_id'] not in skip:
+                    suggestions[c['_id']] = c
+
+        # keep the order of the manpage collection
+        return [(oid, manpage.from_store_name_only(suggestions[oid]['name'],
+                                                   suggestions[oid]['source']))
+                for oid in sorted(suggestions)]
+
+    def _refreshlookup(self, srcs, collection=None):
+        '''recompute the lookup documents of srcs from mapping and manpage'''
+        if collection is None:
+            collection = self.lookup
+        srcs = list(set(srcs))
+
+        scores = {}
+        cursor = self.mapping.find({'src' : {'$in' : srcs}},
+                                   {'_id' : 0, 'src' : 1, 'dst' : 1, 'score' : 1})
+        for d in cursor:
+            scores.setdefault(d['src'], {})[d['dst']] = d['score']
+        dsts = set(itertools.chain.from_iterable(scores.itervalues()))
+        manpages = list(self.manpage.find({'_id' : {'$in' : list(dsts)}}, _explainfields()))
+        # a man page is the first candidate of all of its aliases, so lookup
+        # keeps the hashes of the texts rather than repeating them, they're
+        # resolved through the text cache
+        if len(manpages) != len(dsts):
+            logger.error('one of %r mappings is missing in manpage collection '
+                         '(%d mappings, %d found)', dsts, len(dsts), len(manpages))
+
+        directory = self._directory
+        if collection is not self.lookup:
+            directory = None
+
+        for src in srcs:
+            srcscores = scores.get(src, {})
+            candidates = [d for d in manpages if d['_id'] in srcscores]
+            if not candidates:
+                collection.remove({'_id' : src})
+                if directory is not None:
+                    directory.discard(src)
+                continue
+            if directory is not None:
+                directory.add(src)
+            candidates.sort(key=lambda d: srcscores[d['_id']], reverse=True)
+            collection.update({'_id' : src},
+                              {'_id' : src,
+                               'candidates' : [{'_id' : d['_id'], 'name' : d['name'],
+                                                'source' : d['source'],
+                                                'score' : srcscores[d['_id']]}
+                                               for d in candidates],
+                               'manpage' : candidates[0]}, upsert=True)
+
+    def _srcs(self, manpageid):
+        cursor = self.mapping.find({'dst' : manpageid}, {'_id' : 0, 'src' : 1})
+        return [d['src'] for d in cursor]
+
+    def rebuildlookup(self):
+        '''recreate the lookup collection from scratch
+
+        it's built in a temporary collection that replaces lookup when done'''
+        logger.info('rebuilding lookup collection')
+        tmp = self.db[self._collectionname('lookup_tmp')]
+        tmp.drop()
+        # this also creates tmp so it can be renamed even if it stays empty
+        self._createlookupindexes(tmp)
+        srcs = self.mapping.distinct('src')
+        for i in range(0, len(srcs), 100):
+            self._refreshlookup(srcs[i:i+100], tmp)
+        tmp.rename(self.lookup.name, dropTarget=True)
+        self._directory = None
+        self._bumpgeneration()
+        logger.info('rebuilt lookup for %d names', len(srcs))
 
     def addmapping(self, src, dst, score):
         self.mapping.insert({'src' : src, 'dst' : dst, 'score' : score})
+        self._refreshlookup([src])
+        self._bumpgeneration()
 
     def addmanpage(self, m):
-        '''add m into the store, if it exists first remove it and its mappings
+        '''add m into the store, if it exists replace it and its mappings
 
         each man page may have aliases besides the name determined by its
         basename'''
-        d = self.manpage.find_one({'source' : m.source})
-        if d:
-            logger.info('removing old manpage %s (%s)', m.source, d['_id'])
-            self.manpage.remove(d['_id'])
-
-            # remove old mappings if there are any
-            c = self.mapping.count()
-            self.mapping.remove({'dst' : d['_id']})
-            c -= self.mapping.count()
-            logger.info('removed %d mappings for manpage %s', c, m.source)
-
-        o = self.manpage.insert(m.to_store())
-
-        for alias, score in m.aliases:
-            self.addmapping(alias, o, score)
-            logger.info('inserting mapping (alias) %s -> %s (%s) with score %d', alias, m.name, o, score)
+        self.addmanpages([m])
         return m
 
+    def addmanpages(self, manpages):
+        '''add a batch of man pages like addmanpage, using one query per
+        collection instead of one per man page and alias
+
+        existing man pages are replaced in place: their document keeps its _id
+        and is overwritten in a single update, and only the mappings that
+        changed are added or removed. readers see either the old or the new
+        version, never a missing one.
+
+        return a dict with counts of what was written'''
+        stats = {'manpages' : len(manpages), 'replaced' : 0, 'mappings' : 0,
+                 'removedmappings' : 0, 'removedtexts' : 0}
+        if not manpages:
+            return stats
+
+        cursor = self.manpage.find({'source' : {'$in' : [m.source for m in manpages]}},
+                                   {'source' : 1, 'paragraphs.hash' : 1, 'options.hash' : 1})
+        existing = {}
+        # texts of the replaced man pages, they may not be used anymore
+        replaced = set()
+        for d in cursor:
+            existing[d['source']] = d['_id']
+            replaced.update(_texthashes(d))
+
+        ids = []
+        newdocs = []
+        docs = [m.to_store() for m in manpages]
+        self._storetexts(docs)
+        for m, d in zip(manpages, docs):
+            oid = existing.get(m.source)
+            if oid is not None:
+                logger.info('replacing manpage %s (%s)', m.source, oid)
+                d['_id'] = oid
+                self.manpage.update({'_id' : oid}, d)
+            else:
+                newdocs.append(d)
+            ids.append(oid)
+        if newdocs:
+            newids = iter(self.manpage.insert(newdocs))
+            ids = [oid if oid is not None else next(newids) for oid in ids]
+        stats['replaced'] = len(existing)
+
+        # (src, dst) -> score for the mappings we want, and what we have for
+        # the replaced man pages
+        wanted = collections.OrderedDict()
+        for m, oid in zip(manpages, ids):
+            for alias, score in m.aliases:
+                wanted[(alias, oid)] = score
+        current = {}
+        if existing:
+            cursor = self.mapping.find({'dst' : {'$in' : existing.values()}})
+            for d in cursor:
+                current[(d['src'], d['dst'])] = d
+
+        mappings = []
+        for (src, dst), score in wanted.iteritems():
+            d = current.get((src, dst))
+            if d is None:
+                mappings.append({'src' : src, 'dst' : dst, 'score' : score})
+                logger.info('inserting mapping (alias) %s -> %s with score %d', src, dst, score)
+            elif d['score'] != score:
+                self.mapping.update({'_id' : d['_id']}, {'$set' : {'score' : score}})
+        if mappings:
+            self.mapping.insert(mappings)
+        stats['mappings'] = len(mappings)
+
+        stale = [d['_id'] for key, d in current.iteritems() if key not in wanted]
+        if stale:
+            self.mapping.remove({'_id' : {'$in' : stale}})
+        stats['removedmappings'] = len(stale)
+
+        srcs = set(src for src, dst in wanted)
+        srcs.update(src for src, dst in current)
+        self._refreshlookup(srcs)
+        self._bumpgeneration()
+        # lookup no longer refers to the old texts either
+        replaced.difference_update(*[_texthashes(d) for d in docs])
+        stats['removedtexts'] = self.sweeptexts(replaced)
+        logger.info('added manpages: %r', stats)
+        return stats
+
     def updatemanpage(self, m):
         '''update m and add new aliases if necessary
 
         change updated attribute so we don't overwrite this in the future'''
         logger.info('updating manpage %s', m.source)
         m.updated = True
-        self.manpage.update({'source' : m.source}, m.to_store())
-        _id = self.manpage.find_one({'source' : m.source}, fields={'_id':1})['_id']
+        d = m.to_store()
+        self._storetexts([d])
+        old = self.manpage.find_and_modify({'source' : m.source}, d,
+                                           fields={'_id' : 1, 'paragraphs.hash' : 1,
+                                                   'options.hash' : 1})
+        _id = old['_id']
+
+        aliases = [alias for alias, score in m.aliases]
+        cursor = self.mapping.find({'src' : {'$in' : aliases}}, {'_id' : 0, 'src' : 1})
+        existing = set(d['src'] for d in cursor)
+        mappings = []
         for alias, score in m.aliases:
-            if alias not in self:
-                self.addmapping(alias, _id, score)
+            if alias not in existing:
+                mappings.append({'src' : alias, 'dst' : _id, 'score' : score})
                 logger.info('inserting mapping (alias) %s -> %s (%s) with score %d', alias, m.name, _id, score)
             else:
                 logger.debug('mapping (alias) %s -> %s (%s) already exists', alias, m.name, _id)
+        if mappings:
+            self.mapping.insert(mappings)
+        self._refreshlookup(self._srcs(_id))
+        self._bumpgeneration()
+        self.sweeptexts(_texthashes(old) - _texthashes(d))
         return m
 
-    def verify(self):
-        # check that everything in manpage is reachable
-        mappings = list(self.mapping.find())
-        reachable = set([m['dst'] for m in mappings])
-        manpages = set([m['_id'] for m in self.manpage.find(fields={'_id':1})])
-
+    def sweeptexts(self, hashes=None, batchsize=1000):
+        '''remove the texts that no man page refers to from the text
+        collection, out of hashes or all of them if hashes is None, and
+        return how many were removed
+
+        a text that another writer stored for a man page it hasn't written
+        yet looks unused, so this must not race with other writers to the
+        corpus'''
+        if hashes is None:
+            used = set()
+            cursor = self.manpage.find(fields={'_id' : 0, 'paragraphs.hash' : 1,
+                                               'options.hash' : 1})
+            for d in cursor:
+                used.update(_texthashes(d))
+            candidates = (d['_id'] for d in self.text.find(fields={'_id' : 1}))
+        else:
+            if not hashes:
+                return 0
+            hashes = list(hashes)
+            cursor = self.manpage.find({'$or' : [{'paragraphs.hash' : {'$in' : hashes}},
+                                                 {'options.hash' : {'$in' : hashes}}]},
+                                       {'_id' : 0, 'paragraphs.hash' : 1, 'options.hash' : 1})
+            used = set()
+            for d in cursor:
+                used.update(_texthashes(d))
+            candidates = iter(hashes)
+
+        n = 0
+        for batch in util.chunks(candidates, batchsize):
+            unused = [h for h in batch if h not in used]
+            if unused:
+                self.text.remove({'_id' : {'$in' : unused}})
+                n += len(unused)
+        logger.info('removed %d unused texts', n)
+        return n
+
+    def verify(self, batchsize=1000):
+        '''check the integrity of the corpus:
+
+        - every man page is reachable (some mapping points to it)
+        - every mapping points to an existing man page
+        - every alias of a man page has a mapping to it
+        - every multicommand has sub commands
+        - the text of every paragraph is in the text collection
+
+        manpage and mapping are streamed with projections and checked
+        against each other in batches of batchsize, so memory use doesn't
+        grow with the size of the corpus. progress is logged after every
+        batch
+
+        return (ok, unreachable, notfound) where unreachable are the names of
+        unreachable man pages and notfound the dsts of mappings that point to
+        missing man pages'''
         ok = True
-        unreachable = manpages - reachable
-        if unreachable:
-            logger.error('manpages %r are unreachable (nothing maps to them)', unreachable)
-            unreachable = [self.manpage.find_one({'_id' : u})['name'] for u in unreachable]
-            ok = False
-
-        notfound = reachable - manpages
-        if notfound:
-            logger.error('mappings to inexisting manpages: %r', notfound)
-            ok = False
-
+        unreachable = []
+        notfound = []
+        multicommands = []
+
+        total = self.manpage.count()
+        checked = 0
+        cursor = self.manpage.find(fields={'name' : 1, 'aliases' : 1, 'multicommand' : 1,
+                                           'paragraphs.hash' : 1, 'options.hash' : 1},
+                                   sort=[('_id', pymongo.ASCENDING)])
+        for batch in util.chunks(cursor, batchsize):
+            hashes = set().union(*[_texthashes(d) for d in batch])
+            found = set(x['_id'] for x in self.text.find({'_id' : {'$in' : list(hashes)}},
+                                                        {'_id' : 1}))
+            if len(found) != len(hashes):
+                logger.error('texts %r are missing from the text collection',
+                             sorted(hashes - found))
+                ok = False
+
+            srcs = collections.defaultdict(set)
+            mappings = self.mapping.find({'dst' : {'$in' : [d['_id'] for d in batch]}},
+                                         {'_id' : 0, 'src' : 1, 'dst' : 1})
+            for d in mappings:
+                srcs[d['dst']].add(d['src'])
+
+            for d in batch:
+                if d['_id'] not in srcs:
+                    logger.error('manpage %r (%s) is unreachable (nothing maps to it)',
+                                 d['name'], d['_id'])
+                    unreachable.append(d['name'])
+                    ok = False
+                    continue
+                missing = [alias for alias, score in d['aliases']
+                           if alias not in srcs[d['_id']]]
+                if missing:
+                    logger.error('aliases %r of manpage %r (%s) have no mapping',
+                                 missing, d['name'], d['_id'])
+                    ok = False
+                if d.get('multicommand'):
+                    multicommands.append(d['name'])
+
+            checked += len(batch)
+            logger.info('verified %d/%d manpages', checked, total)
+
+        # mappings sorted by dst, so each dst is checked once
+        cursor = self.mapping.find(fields={'_id' : 0, 'dst' : 1},
+                                   sort=[('dst', pymongo.ASCENDING)])
+        dsts = (dst for dst, group in itertools.groupby(d['dst'] for d in cursor))
+        for batch in util.chunks(dsts, batchsize):
+            found = set(d['_id'] for d in self.manpage.find({'_id' : {'$in' : batch}},
+                                                            {'_id' : 1}))
+            missing = [dst for dst in batch if dst not in found]
+            if missing:
+                logger.error('mappings to inexisting manpages: %r', missing)
+                notfound.extend(missing)
+                ok = False
+
+        for name in multicommands:
+            prefix = '^%s ' % re.escape(name)
+            if not self.mapping.find_one({'src' : {'$regex' : prefix}}, {'_id' : 1}):
+                logger.error('multicommand %r has no sub commands', name)
+                ok = False
+
+        logger.info('verified %d manpages, ok = %r', checked, ok)
         return ok, unreachable, notfound
 
     def names(self):
@@ -397,3 +1534,112 @@ class store(object):
 
     def setmulticommand(self, manpageid):
         self.manpage.update({'_id' : manpageid}, {'$set' : {'multicommand' : True}})
+        self._refreshlookup(self._srcs(manpageid))
+        self._bumpgeneration()
+
+# schema migrations, applied in order by store.migrate. the schema version of a
+# db is the number of migrations that were applied to it
+MIGRATIONS = [
+    ('create indexes', store._createindexes),
+    ('build the lookup collection', store.rebuildlookup),
+    ('keep options apart from prose paragraphs', store._splitparagraphs),
+    ('embed explain views in lookup', store.rebuildlookup),
+    ('store paragraph text by hash', store._hashtexts),
+    ('summarize man pages', store._summarize),
+    ('make manpage source unique', store._uniquesources),
+    ('embed text hashes in lookup', store.rebuildlookup),
+    ('remove unused texts', store.sweeptexts),
+]
+SCHEMAVERSION = len(MIGRATIONS)
+
+_sharedlock = threading.Lock()
+_shared = {}
+
+class concurrentstore(object):
+    '''a facade over store s that overlaps the queries of several lookups by
+    running them on a pool of threads
+
+    submit runs any function on the pool and returns its AsyncResult, get()
+    joins on it. findmanpages starts the lookups of all names at once and
+    returns when the slowest one is done. everything else is passed to s
+
+    lookups the matcher makes while visiting a command line (nested commands,
+    options of an explain view loaded as they're used) depend on what it
+    visited before them, so they still run one after the other'''
+    def __init__(self, s, threads=config.STORE_THREADS):
+        self.store = s
+        self._pool = multiprocessing.pool.ThreadPool(threads)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.store.close()
+
+    def submit(self, fn, *args, **kwargs):
+        return self._pool.apply_async(fn, args, kwargs)
+
+    def findmanpage(self, name, explain=False):
+        return self.store.findmanpage(name, explain)
+
+    def findmanpages(self, names, explain=False):
+        '''see store.findmanpages'''
+        # names without a section are resolved together with a single query
+        # on this thread. the others need queries of their own (suggestions,
+        # the man page of the section) so each gets a thread
+        batch = []
+        futures = {}
+        for name in set(names):
+            if name.endswith('.gz') or splitname(name)[1] is not None:
+                futures[name] = self.submit(self.store.findmanpages, [name], explain)
+            else:
+                batch.append(name)
+
+        results = {}
+        if batch:
+            results = self.store.findmanpages(batch, explain)
+        for name, f in futures.iteritems():
+            results.update(f.get())
+        return results
+
+def shared(db='explainshell', host=config.MONGO_URI):
+    '''return a store for db at host that is shared by all callers in the
+    current process
+
+    stores are keyed by the pid that created them, so a store that was created
+    before forking (e.g. in the uwsgi master) is never used by a worker. each
+    worker creates its own client on first use, with the pool size and timeouts
+    from config. a mongodb store refuses to serve from a db that wasn't
+    migrated to the current schema version
+
+    if config.SNAPSHOT is set, the returned store reads from that snapshot
+    instead of mongodb. otherwise if config.STORE_THREADS is more than one
+    it's wrapped in a concurrentstore'''
+    key = (db, host)
+    pid = os.getpid()
+    with _sharedlock:
+        entry = _shared.get(key)
+        if entry is None or entry[0] != pid:
+            logger.info('creating shared store for pid %d', pid)
+            if config.SNAPSHOT:
+                from explainshell import snapshot
+                s = snapshot.snapshotstore(config.SNAPSHOT)
+            else:
+                s = store(db, host, follow=True, max_pool_size=config.MONGO_MAX_POOL_SIZE,
+                          connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+                          socketTimeoutMS=config.MONGO_SOCKET_TIMEOUT_MS,
+                          _connect=False)
+                try:
+                    s.checkschema()
+                except:
+                    # nothing is cached, don't leave the client behind
+                    s.close()
+                    raise
+                if config.STORE_THREADS > 1:
+                    s = concurrentstore(s, config.STORE_THREADS)
+            entry = _shared[key] = (pid, s)
+        return entry[1]
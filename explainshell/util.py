@@ -1,4 +1,4 @@
-import itertools
+import itertools, collections, threading, contextlib, os
 from operator import itemgetter
 
 def consecutive(l, fn):
@@ -75,6 +75,44 @@ def pairwise(iterable):
     next(b, None)
     return itertools.izip(a, b)
 
+def chunks(iterable, n):
+    '''yield lists of up to n consecutive items of iterable
+
+    >>> list(chunks(xrange(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(chunks([], 2))
+    []
+    '''
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+@contextlib.contextmanager
+def atomicwrite(path):
+    '''open a temporary file for writing that replaces path when the block
+    completes, so readers never see a partial file. the temporary file is
+    removed if the block raises
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> with atomicwrite(os.path.join(d, 'f')) as f:
+    ...     f.write('foo')
+    >>> open(os.path.join(d, 'f')).read(), os.listdir(d)
+    ('foo', ['f'])
+    >>> shutil.rmtree(d)
+    '''
+    tmppath = '%s.tmp' % path
+    try:
+        with open(tmppath, 'wb') as f:
+            yield f
+    except:
+        os.remove(tmppath)
+        raise
+    os.rename(tmppath, path)
+
 class peekable(object):
     '''
     >>> it = peekable(iter('abc'))
@@ -143,3 +181,89 @@ class propertycache(object):
 
     def cachevalue(self, obj, value):
         setattr(obj, self.name, value)
+
+class lrucache(object):
+    '''a dict-like cache that evicts the least recently used items once the
+    total weight of its values exceeds maxsize
+
+    weight is a function that returns the cost of a value, by default every
+    value costs 1
+
+    >>> c = lrucache(2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c['a']
+    1
+    >>> c['c'] = 3
+    >>> 'b' in c, 'a' in c, 'c' in c
+    (False, True, True)
+    >>> c['b']
+    Traceback (most recent call last):
+      File "<stdin>", line 1, in ?
+    KeyError: 'b'
+    >>> sorted(c.stats().items())
+    [('evictions', 1), ('hits', 1), ('misses', 1), ('size', 2)]
+    >>> c.discard('a')
+    >>> 'a' in c, len(c)
+    (False, 1)
+    >>> c = lrucache(5, weight=len)
+    >>> c['a'] = 'xxx'
+    >>> c['b'] = 'xxxx'
+    >>> 'a' in c, len(c)
+    (False, 1)
+    >>> c['c'] = 'xxxxxx'
+    >>> 'b' in c, 'c' in c
+    (True, False)
+    '''
+    def __init__(self, maxsize, weight=None):
+        self.maxsize = maxsize
+        self.weight = weight or (lambda value: 1)
+        self.hits = self.misses = self.evictions = 0
+        self._size = 0
+        self._d = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value, weight = self._d.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._d[key] = value, weight
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        weight = self.weight(value)
+        with self._lock:
+            if key in self._d:
+                self._size -= self._d.pop(key)[1]
+            if weight > self.maxsize:
+                return
+            self._d[key] = value, weight
+            self._size += weight
+            while self._size > self.maxsize:
+                _, (_, w) = self._d.popitem(last=False)
+                self._size -= w
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._d:
+                self._size -= self._d.pop(key)[1]
+
+    def __len__(self):
+        return len(self._d)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self._size = 0
+
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses,
+                'evictions' : self.evictions, 'size' : self._size}
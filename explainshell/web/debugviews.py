@@ -1,28 +1,43 @@
 import logging
 
-from flask import render_template, request, abort, redirect, url_for, json
+from flask import render_template, request, abort, redirect, url_for, json, \
+                  Response, stream_with_context
 
 from explainshell import manager, config, store
 from explainshell.web import app, helpers
 
 logger = logging.getLogger(__name__)
 
+PAGESIZE = 500
+
+def _streamtemplate(name, **context):
+    app.update_template_context(context)
+    t = app.jinja_env.get_template(name)
+    rv = t.stream(context)
+    rv.enable_buffering(50)
+    return Response(stream_with_context(rv))
+
 @app.route('/debug')
 def debug():
-    s = store.store('explainshell', config.MONGO_URI)
-    d = {'manpages' : []}
-    for mp in s:
-        synopsis = ''
-        if mp.synopsis:
-            synopsis = mp.synopsis[:20]
-        dd = {'name' : mp.name, 'synopsis' : synopsis}
-        l = []
-        for o in mp.options:
-            l.append(str(o))
-        dd['options'] = ', '.join(l)
-        d['manpages'].append(dd)
-    d['manpages'].sort(key=lambda d: d['name'].lower())
-    return render_template('debug.html', d=d)
+    s = store.shared('explainshell', config.MONGO_URI)
+    page = request.args.get('page', 0, type=int)
+    if page < 0:
+        abort(404)
+
+    # one more than we show, to tell if there's a next page
+    summaries = s.summaries(page * PAGESIZE, PAGESIZE + 1)
+    def manpages():
+        for i, (name, summary) in enumerate(summaries):
+            if i == PAGESIZE:
+                d['next'] = page + 1
+                return
+            yield {'name' : name, 'synopsis' : summary['synopsis'],
+                   'options' : summary['options']}
+
+    d = {'manpages' : manpages(), 'page' : page, 'next' : None}
+    if page:
+        d['previous'] = page - 1
+    return _streamtemplate('debug.html', d=d)
 
 def _convertvalue(value):
     if isinstance(value, list):
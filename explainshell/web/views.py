@@ -4,12 +4,17 @@ import markupsafe
 from flask import render_template, request, redirect
 
 import bashlex.errors
+import pymongo.errors
 
 from explainshell import matcher, errors, util, store, config
 from explainshell.web import app, helpers
 
 logger = logging.getLogger(__name__)
 
+# (command, store.cachekey()) -> the rendered explanation of command. keys of
+# an older corpus are never asked for again and are evicted in time
+_explained = util.lrucache(config.WEB_CACHE_EXPLAINS, weight=len)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -18,6 +23,16 @@ def index():
 def about():
     return render_template('about.html')
 
+@app.route('/health')
+def health():
+    try:
+        s = store.shared('explainshell', config.MONGO_URI)
+        if s.ping():
+            return 'ok'
+    except (pymongo.errors.PyMongoError, errors.SchemaOutdated), e:
+        logger.error('store is unavailable: %s', e)
+    return 'unavailable', 503
+
 @app.route('/explain')
 def explain():
     if 'cmd' not in request.args or not request.args['cmd'].strip():
@@ -28,13 +43,20 @@ def explain():
         return render_template('errors/error.html', title='parsing error!',
                                message='no newlines please')
 
-    s = store.store('explainshell', config.MONGO_URI)
+    s = store.shared('explainshell', config.MONGO_URI)
+    key = (command, s.cachekey())
+    try:
+        return _explained[key]
+    except KeyError:
+        pass
+
     try:
         matches, helptext = explaincommand(command, s)
-        return render_template('explain.html',
-                               matches=matches,
-                               helptext=helptext,
-                               getargs=command)
+        html = _explained[key] = render_template('explain.html',
+                                                 matches=matches,
+                                                 helptext=helptext,
+                                                 getargs=command)
+        return html
 
     except errors.ProgramDoesNotExist, e:
         return render_template('errors/missingmanpage.html', title='missing man page', e=e)
@@ -58,7 +80,7 @@ def explain():
 def explainold(section, program):
     logger.info('/explain section=%r program=%r', section, program)
 
-    s = store.store('explainshell', config.MONGO_URI)
+    s = store.shared('explainshell', config.MONGO_URI)
     if section is not None:
         program = '%s.%s' % (program, section)
 
@@ -28,10 +28,25 @@ class mockstore(object):
         opts = list(opts)
         opts.append(so(p4, [], [], False, 'FILE'))
         opts.append(so(p5, ['-exec'], [], True, nestedcommand=['EOF', ';']))
+        p6 = sp(6, '--verbose desc', '', True)
+        p7 = sp(7, '--version desc', '', True)
+        p8 = sp(8, '--color desc', '', True)
+        p9 = sp(9, '--uber desc', '', True)
+        p10 = sp(10, '--uberall desc', '', True)
+        p11 = sp(11, '--debug desc', '', True)
+        # flags that come from the store are unicode
+        self.manpages['long'] = sm('long.1.gz', 'long', 'long synopsis',
+                                   [so(p6, [], [u'--verbose'], False),
+                                    so(p7, [], [u'--version'], False),
+                                    so(p8, [], [u'--color', u'--colour'], False),
+                                    so(p9, [], [u'--\xfcber'], False),
+                                    so(p10, [], [u'--\xfcberall'], False),
+                                    so(p11, [], [u'--d\xe9bug'], False)], [])
+
         self.manpages['withargs'] = sm('withargs.1.gz', 'withargs', 'withargs synopsis',
                                        opts, [], partialmatch=True, nestedcommand=True)
 
-    def findmanpage(self, x, section=None):
+    def findmanpage(self, x, section=None, explain=False):
         try:
             if x == 'dup':
                 return self.dup
@@ -39,5 +54,14 @@ class mockstore(object):
         except KeyError:
             raise errors.ProgramDoesNotExist(x)
 
+    def findmanpages(self, names, explain=False):
+        results = {}
+        for name in names:
+            try:
+                results[name] = self.findmanpage(name)
+            except errors.ProgramDoesNotExist, e:
+                results[name] = e
+        return results
+
 s = mockstore()
 
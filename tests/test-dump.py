@@ -0,0 +1,47 @@
+import unittest, tempfile, shutil, os
+
+from explainshell import dump, store
+from tests import helpers
+
+s = helpers.mockstore()
+
+class test_dump(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dump')
+
+        manpages = [('bar', s.manpages['bar']), ('withargs', s.manpages['withargs'])]
+        mappings = [('bar', 'bar', 10), ('withargs', 'withargs', 10), ('w', 'withargs', 1)]
+        dump.write(self.path, manpages, mappings)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        self.assertEquals(dump.check(self.path), 5)
+        records = list(dump.read(self.path))
+        self.assertEquals([kind for kind, d in records], ['m', 'm', 'p', 'p', 'p'])
+
+        d = records[1][1]
+        self.assertEquals(d['_id'], 'withargs')
+        m = store.manpage.from_store(d)
+        expected = s.manpages['withargs']
+        self.assertEquals(m.paragraphs, expected.paragraphs)
+        self.assertEquals(m.arguments, expected.arguments)
+        self.assertEquals(records[4][1], {'src' : 'w', 'dst' : 'withargs', 'score' : 1})
+
+    def test_corrupt(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        def check(data):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertRaises(ValueError, dump.check, self.path)
+            self.assertRaises(ValueError, list, dump.read(self.path))
+
+        i = data.index('bar synopsis')
+        check(data[:i] + 'B' + data[i+1:])
+        check(data[:-10])
+        check(data + 'x')
+        check('x' * 100)
@@ -1,10 +1,15 @@
-import unittest, os
+import unittest, os, tempfile, shutil
 
-from explainshell import manager, config, store, errors
+import pymongo
+
+from explainshell import manager, config, store, errors, dump
 
 class test_manager(unittest.TestCase):
     def setUp(self):
-        store.store('explainshell_tests').drop(True)
+        s = store.store('explainshell_tests', corpus='')
+        s.drop(True)
+        s.meta.remove({'_id' : 'corpus'})
+        store.store('explainshell_tests', corpus='green').drop(True)
 
     def _getmanager(self, names, **kwargs):
         l = []
@@ -32,6 +37,74 @@ class test_manager(unittest.TestCase):
 
         self.assertEquals(m.run()[0], [])
 
+    def test_cache(self):
+        m = self._getmanager(['tar.1.gz'])
+        s = m.store
+
+        # unknown names never reach the db
+        self.assertRaises(errors.ProgramDoesNotExist, s.findmanpage, 'tar')
+        self.assertRaises(errors.ProgramDoesNotExist, s.findmanpage, 'tar.1')
+        self.assertEquals(s.cachestats()['directory']['unknown'], 2)
+
+        # adding a man page updates the directory
+        m.run()
+        mp = s.findmanpage('tar')[0]
+        self.assertEquals(mp.source, 'tar.1.gz')
+        self.assertTrue(s.findmanpage('tar')[0] is mp)
+        self.assertEquals(s.cachestats()['lookups']['hits'], 1)
+        self.assertEquals(s.cachestats()['directory']['size'], 1)
+
+        # the explain view has no prose, and the options past
+        # STORE_EXPLAIN_OPTIONS are loaded as they're used
+        e = s.findmanpage('tar', explain=True)[0]
+        self.assertTrue(isinstance(e, store.explainmanpage))
+        self.assertEquals(e.paragraphs, mp.options[:config.STORE_EXPLAIN_OPTIONS])
+        for o in mp.options:
+            self.assertEquals(e.find_option(o.opts[0]), mp.find_option(o.opts[0]))
+        self.assertEquals(e.arguments, mp.arguments)
+
+        # an edit made through another store is picked up once s checks the
+        # generation
+        key = s.cachekey()
+        other = store.store('explainshell_tests')
+        omp = other.findmanpage('tar')[0]
+        self.assertFalse(omp is mp)
+        omp.synopsis = 'foo'
+        other.updatemanpage(omp)
+
+        s._generationchecked = 0
+        newmp = s.findmanpage('tar')[0]
+        self.assertFalse(newmp is mp)
+        self.assertEquals(newmp.synopsis, 'foo')
+        self.assertEquals(mp.synopsis, 'The GNU version of the tar archiving utility')
+        self.assertNotEqual(s.cachekey(), key)
+
+    def test_explainversion(self):
+        m = self._getmanager(['tar.1.gz'])
+        m.run()
+        s = m.store
+        explainoptions = config.STORE_EXPLAIN_OPTIONS
+        config.STORE_EXPLAIN_OPTIONS = 1
+        try:
+            e = s.findmanpage('tar', explain=True)[0]
+        finally:
+            config.STORE_EXPLAIN_OPTIONS = explainoptions
+
+        # rewrite tar without its last option through another store, before
+        # s checks the generation
+        other = store.store('explainshell_tests')
+        mp = other.findmanpage('tar')[0]
+        last = mp.options[-1]
+        mp.removeoption(last.idx)
+        other.updatemanpage(mp)
+
+        # the position e has for the flag is from the old version
+        self.assertEquals(e.find_option(last.opts[0]), None)
+        ee = s.findmanpage('tar', explain=True)[0]
+        self.assertFalse(ee is e)
+        self.assertEquals(ee.find_option(last.opts[0]), None)
+        self.assertEquals(ee.find_option('-v'), mp.find_option('-v'))
+
     def test_verify(self):
         m = self._getmanager(['tar.1.gz'])
         s = m.store
@@ -43,10 +116,18 @@ class test_manager(unittest.TestCase):
         self.assertEquals(list(notfound), ['bar'])
 
         s.mapping.drop()
+        s.rebuildlookup()
         m.run()
         ok, unreachable, notfound = s.verify()
         self.assertTrue(ok)
 
+        # a multicommand without sub commands
+        tarid = s.manpage.find_one({'name' : 'tar'})['_id']
+        s.setmulticommand(tarid)
+        self.assertFalse(s.verify()[0])
+        s.addmapping('tar foo', tarid, 1)
+        self.assertTrue(s.verify(batchsize=1)[0])
+
         s.mapping.drop()
         ok, unreachable, notfound = s.verify()
         self.assertEquals(list(unreachable), ['tar'])
@@ -71,6 +152,160 @@ class test_manager(unittest.TestCase):
         self.assertEquals(mp[0].source, 'tar.1.gz')
         self.assertEquals(mp[1].source, 'bsdtar.1.gz')
 
+    def test_migrate(self):
+        m = self._getmanager([])
+        s = m.store
+        self.assertEquals(s.schemaversion(), store.SCHEMAVERSION)
+        s.checkschema()
+        self.assertEquals(s.migrate(), 0)
+        self.assertTrue('src_1_dst_1_score_1' in s.mapping.index_information())
+        self.assertTrue(s.manpage.index_information()['source_1']['unique'])
+
+        s.drop(True)
+        self.assertRaises(errors.SchemaOutdated, s.checkschema)
+        self.assertEquals(s.migrate(), store.SCHEMAVERSION)
+        s.checkschema()
+
+    def test_rebuildlookup(self):
+        m = self._getmanager(['tar.1.gz', 'bsdtar.1.gz'])
+        m.run()
+
+        m.store.lookup.drop()
+        self.assertRaises(errors.ProgramDoesNotExist, m.store.findmanpage, 'tar')
+
+        m.store.rebuildlookup()
+        mp = m.store.findmanpage('tar')
+        self.assertEquals([x.source for x in mp], ['tar.1.gz', 'bsdtar.1.gz'])
+        self.assertEquals(m.store.lookup.count(), len(m.store.mapping.distinct('src')))
+
+    def test_corpus(self):
+        m = self._getmanager(['tar.1.gz'])
+        m.run()
+        reader = store.store('explainshell_tests', follow=True)
+        self.assertEquals(reader.corpus, '')
+
+        n = self._getmanager(['bsdtar.1.gz'], corpus='green')
+        n.run()
+        self.assertEquals([mp.source for mp in reader.findmanpage('tar')], ['tar.1.gz'])
+        self.assertRaises(errors.ProgramDoesNotExist, reader.findmanpage, 'bsdtar')
+
+        self.assertEquals(n.store.activate(), '')
+        reader._generationchecked = 0
+        self.assertEquals([mp.source for mp in reader.findmanpage('tar')], ['bsdtar.1.gz'])
+        self.assertEquals(reader.corpus, 'green')
+
+        # writers stay in the corpus they were created in
+        m.store._generationchecked = 0
+        self.assertRaises(errors.ProgramDoesNotExist, m.store.findmanpage, 'bsdtar')
+        self.assertEquals(m.store.corpus, '')
+
+        self.assertEquals(reader.rollback(), '')
+        reader._generationchecked = 0
+        self.assertRaises(errors.ProgramDoesNotExist, reader.findmanpage, 'bsdtar')
+        self.assertEquals(reader.corpus, '')
+
+    def test_compresstext(self):
+        m = self._getmanager(['tar.1.gz'])
+        m.store.compresstext = 1
+        m.run()
+
+        self.assertTrue(m.store.text.find_one({'zlib' : {'$exists' : True}}))
+        # lookup embeds the hashes of the texts, not the texts
+        d = m.store.lookup.find_one({'_id' : 'tar'})
+        options = d['manpage']['options']
+        self.assertTrue(all('hash' in od and 'text' not in od for od in options))
+        m.store.rebuildlookup()
+        compressed = set(x['_id'] for x in m.store.text.find({'zlib' : {'$exists' : True}}))
+        e = m.store.findmanpage('tar', explain=True)[0]
+        o = e.paragraphs[[(od['hash'] in compressed) for od in options].index(True)]
+        self.assertTrue(callable(o._text))
+        self.assertTrue(o.text)
+        mp = m.store.findmanpage('tar')[0]
+        self.assertTrue(callable(mp.paragraphs[0]._text))
+        self.assertEquals(mp.synopsis, 'The GNU version of the tar archiving utility')
+        self.assertTrue(mp.find_option('-v').text)
+
+        [(source, size, stored, seconds)] = list(m.store.textstats())
+        self.assertEquals(source, 'tar.1.gz')
+        self.assertTrue(stored < size)
+
+    def test_dump(self):
+        m = self._getmanager(['tar.1.gz', 'bsdtar.1.gz'])
+        m.run()
+
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'dump')
+            dump.export(m.store, path)
+            green = store.store('explainshell_tests', corpus='green')
+            self.assertEquals(dump.load(green, path),
+                              (m.store.manpage.count(), m.store.mapping.count()))
+            self.assertRaises(ValueError, dump.load, green, path)
+        finally:
+            shutil.rmtree(d)
+
+        green.checkschema()
+        self.assertTrue(green.verify()[0])
+        self.assertEquals([mp.source for mp in green.findmanpage('tar')],
+                          [mp.source for mp in m.store.findmanpage('tar')])
+        self.assertEquals(green.findmanpage('tar')[0].paragraphs,
+                          m.store.findmanpage('tar')[0].paragraphs)
+
+    def test_addmanpages(self):
+        m = self._getmanager(['tar.1.gz', 'bsdtar.1.gz'], batchsize=1)
+        a, e = m.run()
+        self.assertEquals(len(a), 2)
+
+        nmappings = sum(len(mp.aliases) for mp in a)
+        self.assertEquals(m.store.mapping.count(), nmappings)
+
+        ids = dict((d['source'], d['_id']) for d in m.store.manpage.find())
+        ntexts = m.store.text.count()
+        stats = m.store.addmanpages(a)
+        # same paragraphs, same texts
+        self.assertEquals(m.store.text.count(), ntexts)
+        self.assertEquals(stats, {'manpages' : 2, 'replaced' : 2, 'mappings' : 0,
+                                  'removedmappings' : 0, 'removedtexts' : 0})
+        self.assertEquals(m.store.mapping.count(), nmappings)
+        self.assertEquals([mp.source for mp in m.store.findmanpage('tar')],
+                          ['tar.1.gz', 'bsdtar.1.gz'])
+        self.assertTrue(m.store.verify()[0])
+
+        # replaced in place, with only the changed aliases written
+        self.assertEquals(dict((d['source'], d['_id']) for d in m.store.manpage.find()), ids)
+        bsdtar = [mp for mp in a if mp.source == 'bsdtar.1.gz'][0]
+        old = set(alias for alias, score in bsdtar.aliases)
+        new = set(['bsdtar', 'foo'])
+        self.assertTrue('tar' in old)
+        bsdtar.aliases = [('bsdtar', 10), ('foo', 1)]
+        stats = m.store.addmanpages([bsdtar])
+        self.assertEquals((stats['mappings'], stats['removedmappings']),
+                          (len(new - old), len(old - new)))
+        self.assertEquals([mp.source for mp in m.store.findmanpage('tar')], ['tar.1.gz'])
+        self.assertEquals([mp.source for mp in m.store.findmanpage('foo')], ['bsdtar.1.gz'])
+
+    def test_sweeptexts(self):
+        m = self._getmanager(['tar.1.gz'])
+        [tar], e = m.run()
+        s = m.store
+        ntexts = s.text.count()
+
+        # the replaced text goes away with the old version of the man page
+        p = tar.options[0]
+        oldhash = store.texthash(p.text)
+        p.text = 'changed desc'
+        stats = s.addmanpages([tar])
+        self.assertEquals(stats['removedtexts'], 1)
+        self.assertFalse(s.text.find_one({'_id' : oldhash}))
+        self.assertEquals(s.text.count(), ntexts)
+        self.assertTrue(s.verify()[0])
+
+        s.text.insert({'_id' : store.texthash('orphan'), 'text' : 'orphan'})
+        self.assertEquals(s.sweeptexts(), 1)
+        self.assertEquals(s.sweeptexts(), 0)
+        self.assertEquals(s.text.count(), ntexts)
+        self.assertTrue(s.verify()[0])
+
     def test_overwrite(self):
         m = self._getmanager(['tar.1.gz'], overwrite=False)
         self.assertEquals(len(list(m.store)), 0)
@@ -96,6 +331,48 @@ class test_manager(unittest.TestCase):
 
         m.store.verify()
 
+    def test_samesource(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'tar.1.gz')
+            shutil.copy(os.path.join(config.MANPAGEDIR, '1', 'tar.1.gz'), path)
+
+            m = self._getmanager(['tar.1.gz'], overwrite=False)
+            m.paths.append(path)
+            a, e = m.run()
+            self.assertEquals([x.path for x in a], [m.paths[0]])
+            self.assertEquals([x.path for x in e], [path])
+            self.assertEquals(m.store.manpage.find({'source' : 'tar.1.gz'}).count(), 1)
+
+            m.store.drop(True)
+            m = self._getmanager(['tar.1.gz'], overwrite=True)
+            m.paths.append(path)
+            a, e = m.run()
+            self.assertEquals([x.path for x in a], [path])
+            self.assertFalse(e)
+            self.assertEquals(m.store.manpage.find({'source' : 'tar.1.gz'}).count(), 1)
+        finally:
+            shutil.rmtree(d)
+
+    def test_uniquesources(self):
+        m = self._getmanager(['tar.1.gz'])
+        m.run()
+        s = m.store
+        s.manpage.drop_index('source_1')
+        s.manpage.create_index('source')
+        d = s.manpage.find_one({'source' : 'tar.1.gz'})
+        first = d.pop('_id')
+        second = s.manpage.insert(d)
+        s.addmapping('tar', second, 10)
+
+        s._uniquesources()
+        self.assertEquals([x['_id'] for x in s.manpage.find({'source' : 'tar.1.gz'})], [second])
+        self.assertFalse(s.mapping.find({'dst' : first}).count())
+        self.assertEquals(s.findmanpage('tar')[0].source, 'tar.1.gz')
+        del d['_id']
+        self.assertRaises(pymongo.errors.DuplicateKeyError, s.manpage.insert, d)
+        self.assertTrue(s.verify()[0])
+
     def test_multicommand(self):
         m = self._getmanager(['git.1.gz', 'git-rebase.1.gz'])
         m.run()
@@ -133,6 +410,12 @@ class test_manager(unittest.TestCase):
         self.assertEquals(len(mps), 2)
         self.assertEquals(mps[0].section, '8')
 
+        results = m.store.findmanpages(['node', 'node.8', 'node.2', 'nope'])
+        self.assertEquals([mp.source for mp in results['node.8']], [mp.source for mp in mps])
+        self.assertEquals(len(results['node']), 2)
+        self.assertTrue(isinstance(results['node.2'], errors.ProgramDoesNotExist))
+        self.assertTrue(isinstance(results['nope'], errors.ProgramDoesNotExist))
+
     def test_samename_samesection(self):
         m = self._getmanager(['xargs.1.gz', 'xargs.1posix.gz'])
         a, e = m.run()
@@ -172,6 +172,47 @@ class test_matcher(unittest.TestCase):
 
         self.assertMatchSingle(cmd, s.findmanpage('bar')[0], matchedresult)
 
+    def test_long_abbreviation(self):
+        cmd = 'long --verb --col=always --ver --x'
+        matchedresult = [
+            (0, 4, 'long synopsis', 'long'),
+            (5, 11, '--verbose desc', '--verb'),
+            (12, 24, '--color desc', '--col=always'),
+            (25, 30, helpconstants.AMBIGUOUSOPTION % ('--ver', '<b>--verbose</b>, <b>--version</b>'), '--ver'),
+            (31, 34, None, '--x')]
+
+        self.assertMatchSingle(cmd, s.findmanpage('long')[0], matchedresult)
+
+    def test_long_abbreviation_unicode(self):
+        cmd = u'long --c\xf6l --\xfcb --d\xe9 --x'
+        matchedresult = [
+            (0, 4, 'long synopsis', 'long'),
+            (5, 10, None, u'--c\xf6l'),
+            (11, 15, (helpconstants.AMBIGUOUSOPTION %
+                      (u'--\xfcb', u'<b>--\xfcber</b>, <b>--\xfcberall</b>')).encode('utf8'), u'--\xfcb'),
+            (16, 20, '--debug desc', u'--d\xe9'),
+            (21, 24, None, '--x')]
+
+        self.assertMatchSingle(cmd, s.findmanpage('long')[0], matchedresult)
+
+    def test_parsecache(self):
+        cmd = 'bar foo --b foo | bar -a'
+        ast = matcher.parse(cmd)
+        dump = ast.dump()
+        self.assertTrue(matcher.parse(cmd) is ast)
+
+        first = matcher.matcher(cmd, s).match()
+        second = matcher.matcher(cmd, s).match()
+        self.assertEquals([g.results for g in first], [g.results for g in second])
+        self.assertEquals(ast.dump(), dump)
+
+        self.assertRaises(bashlex.errors.ParsingError, matcher.parse, 'bar (')
+        e = matcher._parses['bar (']
+        try:
+            matcher.parse('bar (')
+        except bashlex.errors.ParsingError, ee:
+            self.assertTrue(ee is e)
+
     def test_arg_no_dash(self):
         cmd = 'baz ab -x'
         matchedresult = [
@@ -650,3 +691,60 @@ class test_matcher(unittest.TestCase):
         self.assertEquals(len(groups), 2)
         self.assertEquals(groups[0].results, [])
         self.assertEquals(groups[1].results, matchresults)
+
+    def test_matchmany(self):
+        class countingstore(object):
+            def __init__(self):
+                self.batches = []
+            def findmanpages(self, names, explain=False):
+                self.batches.append(sorted(names))
+                return s.findmanpages(names)
+
+        cs = countingstore()
+        cmds = ['bar -a', 'bar (', 'unknown x', 'withargs -exec dup ;', 'bar -a | baz -b x']
+        results = list(matcher.matchmany(cmds, cs, processes=2, chunksize=2))
+        self.assertEquals([r.command for r in results], cmds)
+
+        # every name is looked up once, the nested command when a matcher
+        # asks for it. the last command is in a window of its own
+        self.assertEquals(cs.batches, [['bar', 'bar -a', 'unknown', 'unknown x',
+                                        'withargs', 'withargs -exec'],
+                                       ['dup'],
+                                       ['baz', 'baz -b']])
+
+        self.assertTrue(isinstance(results[1].error, bashlex.errors.ParsingError))
+        self.assertEquals(results[1].error.position, 5)
+        self.assertTrue(isinstance(results[2].error, errors.ProgramDoesNotExist))
+        for i in (0, 3, 4):
+            r = results[i]
+            self.assertEquals(r.error, None)
+            m = matcher.matcher(cmds[i], s)
+            groups = m.match()
+            self.assertEquals([g.results for g in r.groups], [g.results for g in groups])
+            self.assertEquals(r.expansions, m.expansions)
+            for g, gg in zip(r.groups[1:], groups[1:]):
+                self.assertEquals(g.manpage.source, gg.manpage.source)
+                self.assertEquals(g.manpage.options, gg.manpage.options)
+
+    def test_prefetch(self):
+        class countingstore(object):
+            def __init__(self):
+                self.batches = []
+                self.single = []
+            def findmanpages(self, names, explain=False):
+                self.batches.append(sorted(names))
+                return s.findmanpages(names)
+            def findmanpage(self, name, explain=False):
+                self.single.append(name)
+                return s.findmanpage(name)
+
+        cs = countingstore()
+        cmd = 'bar foo -a | baz $(bar) | unknown x && withargs -exec dup'
+        groups = matcher.matcher(cmd, cs).match()
+        self.assertEquals(len(groups), 6)
+        self.assertEquals(cs.batches, [['bar', 'bar foo', 'baz', 'unknown',
+                                        'unknown x', 'withargs', 'withargs -exec']])
+        self.assertEquals([g.manpage.name for g in groups[1:] if g.manpage],
+                          ['bar-foo', 'baz', 'withargs', 'dup'])
+        # the nested command isn't known ahead of time
+        self.assertEquals(cs.single, ['dup'])
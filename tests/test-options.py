@@ -97,13 +97,13 @@ class test_options(unittest.TestCase):
         r = m.options
         self.assertEquals(len(r), 2)
         self.assertEquals(r[0].text, p1.text)
-        self.assertEquals(r[0].short, [])
-        self.assertEquals(r[0].long, ['--test'])
+        self.assertEquals(r[0].short, ())
+        self.assertEquals(r[0].long, ('--test',))
         self.assertEquals(r[0].expectsarg, True)
 
         self.assertEquals(r[1].text, p3.text)
-        self.assertEquals(r[1].short, [])
-        self.assertEquals(r[1].long, ['--foo-bar'])
+        self.assertEquals(r[1].short, ())
+        self.assertEquals(r[1].long, ('--foo-bar',))
         self.assertEquals(r[1].expectsarg, True)
 
     def test_help(self):
@@ -0,0 +1,116 @@
+import unittest, tempfile, shutil, os, json, mmap
+
+from explainshell import snapshot, store, errors
+from tests import helpers
+
+s = helpers.mockstore()
+
+class test_snapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+
+        manpages = [('bar', s.manpages['bar']),
+                    ('withargs', s.manpages['withargs']),
+                    ('dup1', s.dup[0]),
+                    ('dup2', s.dup[1])]
+        mappings = [('bar', 'bar', 10),
+                    ('withargs', 'withargs', 10),
+                    ('dup', 'dup1', 10),
+                    ('dup', 'dup2', 10),
+                    ('dupalias', 'dup2', 1),
+                    ('missing', 'nothere', 1)]
+        snapshot.write(self.path, manpages, mappings, generation=3)
+        self.store = snapshot.snapshotstore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.assertFalse(self.store.ping())
+        shutil.rmtree(self.dir)
+
+    def test_findmanpage(self):
+        mp = self.store.findmanpage('withargs')
+        self.assertEquals(len(mp), 1)
+        mp = mp[0]
+        expected = s.manpages['withargs']
+        self.assertEquals(mp.name, expected.name)
+        self.assertEquals(mp.synopsis, expected.synopsis)
+        self.assertEquals(mp.paragraphs, expected.paragraphs)
+        self.assertEquals(mp.arguments, expected.arguments)
+        self.assertTrue(mp.nestedcommand)
+        self.assertEquals(mp.find_option('-exec').nestedcommand, ['EOF', ';'])
+
+        self.assertEquals(self.store.findmanpage('bar.1.gz')[0].name, 'bar')
+        self.assertRaises(errors.ProgramDoesNotExist, self.store.findmanpage, 'foo')
+        self.assertRaises(errors.ProgramDoesNotExist, self.store.findmanpage, 'foo.1.gz')
+        self.assertRaises(errors.ProgramDoesNotExist, self.store.findmanpage, 'bar.2')
+
+    def test_sections(self):
+        mps = self.store.findmanpage('dup')
+        self.assertEquals([mp.source for mp in mps], ['dup.1.gz', 'dup.2.gz'])
+
+        mps = self.store.findmanpage('dup.2')
+        self.assertEquals([mp.source for mp in mps], ['dup.2.gz', 'dup.1.gz'])
+        self.assertEquals(mps[0].synopsis, 'dup2 synopsis')
+
+        mps = self.store.findmanpage('dupalias.2')
+        self.assertEquals([mp.source for mp in mps], ['dup.2.gz', 'dup.1.gz'])
+
+    def test_contains_iter(self):
+        self.assertTrue('dupalias' in self.store)
+        self.assertFalse('nothere' in self.store)
+        self.assertEquals([mp.source for mp in self.store],
+                          ['bar.1.gz', 'withargs.1.gz', 'dup.1.gz', 'dup.2.gz'])
+        self.assertEquals(self.store.generation(), 3)
+        self.assertTrue(self.store.ping())
+
+    def test_lazytext(self):
+        mp = self.store.findmanpage('bar')[0]
+        p = mp.paragraphs[0]
+        self.assertTrue(callable(p._text))
+        self.assertEquals(p.text, '-a desc')
+        self.assertEquals(p._text, '-a desc')
+
+    def test_sharedtext(self):
+        d1, d2 = [json.loads(self.store._slice(*self.store._entries[self.store._bysource[source]]['at']))
+                  for source in ('dup.1.gz', 'dup.2.gz')]
+        self.assertEquals([pd['text'] for pd in d1['paragraphs']],
+                          [pd['text'] for pd in d2['paragraphs']])
+
+    def test_lazymanpages(self):
+        # the index has no paragraphs, man pages are decoded when looked up
+        self.assertFalse(any('paragraphs' in e for e in self.store._entries))
+        list(self.store.summaries())
+        list(self.store.names())
+        self.assertEquals(len(self.store._manpages), 0)
+        self.store.findmanpage('dup')
+        self.assertEquals(len(self.store._manpages), 1)
+
+    def test_summaries(self):
+        names = [name for name, summary in self.store.summaries()]
+        self.assertEquals(names, ['bar', 'dup', 'dup', 'withargs'])
+        [(name, summary)] = self.store.summaries(3, 1)
+        self.assertEquals(summary['synopsis'], 'withargs synopsis')
+        self.assertTrue(summary['options'].startswith('(-a, --a), (-b, --b)'))
+
+    def test_badfile(self):
+        maps = []
+        orig = mmap.mmap
+        def recordingmmap(*args, **kwargs):
+            maps.append(orig(*args, **kwargs))
+            return maps[-1]
+        mmap.mmap = recordingmmap
+        try:
+            path = os.path.join(self.dir, 'bad')
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            for content in ['', 'x' * 10, 'x' * 100, data[:-10],
+                            data.replace(snapshot.MAGIC, 'ESSNAQ', 1)]:
+                with open(path, 'wb') as f:
+                    f.write(content)
+                self.assertRaises(ValueError, snapshot.snapshotstore, path)
+        finally:
+            mmap.mmap = orig
+        self.assertEquals(len(maps), 3)
+        for m in maps:
+            self.assertRaises(ValueError, len, m)
@@ -0,0 +1,313 @@
+import unittest, zlib, threading, time, pickle
+
+import bson, bson.binary
+
+from explainshell import store, errors, util
+
+class test_store(unittest.TestCase):
+    def _option(self, idx, short, long, section=u'OPTIONS'):
+        p = store.paragraph(idx, '%s desc' % ' '.join(short + long), section, True)
+        return store.option(p, short, long, False)
+
+    def test_roundtrip(self):
+        p = store.paragraph(0, 'text', u'DESCRIPTION', False)
+        o = self._option(1, [u'-a'], [u'--all'])
+        o.argument = 'FILE'
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis', [p, o], [('foo', 10)])
+
+        d = self._stored(m)
+        self.assertEquals(len(d['paragraphs']), 1)
+        self.assertEquals(d['options'][0]['short'], [u'-a'])
+        self.assertEquals(d['flags'], [[u'-a', 0], [u'--all', 0]])
+        self.assertEquals(d['arguments'], [0])
+        self.assertNotEqual(d['version'], self._stored(store.manpage('foo.1.gz', 'foo', 'foo synopsis', [p], []))['version'])
+
+        mm = store.manpage.from_store(d)
+        self.assertEquals(mm.paragraphs, m.paragraphs)
+        self.assertEquals(mm.options[0].opts, (u'-a', u'--all'))
+        self.assertEquals(mm.aliases, [('foo', 10)])
+
+    def test_optionindex(self):
+        a = self._option(1, [u'-a'], [u'--all'])
+        b = self._option(2, [u'-a', u'-b'], [])
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis',
+                          [store.paragraph(0, 'text', u'DESCRIPTION', False), a, b], [])
+        self.assertEquals(m.options, [a, b])
+        self.assertTrue(m.find_option('-a') is a)
+        self.assertTrue(m.find_option('-b') is b)
+        self.assertEquals(m.find_option('-c'), None)
+
+        m.paragraphs = [b]
+        self.assertTrue(m.find_option('-a') is b)
+
+        m.paragraphs.append(self._option(3, [u'-c'], []))
+        m.invalidate()
+        self.assertEquals(m.find_option('-c').idx, 3)
+
+    def test_completeoption(self):
+        a = self._option(1, [u'-a'], [u'--all', u'--almost'])
+        b = self._option(2, [], [u'--also'])
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis', [a, b], [])
+        self.assertEquals(m.complete_option(u'--alm'), (a, [u'--almost']))
+        self.assertEquals(m.complete_option(u'--all'), (a, [u'--all']))
+        self.assertEquals(m.complete_option(u'--al'), (None, [u'--all', u'--almost', u'--also']))
+        self.assertEquals(m.complete_option(u'--b'), (None, []))
+
+        # flags of the same option aren't ambiguous
+        b.long = (u'--bee', u'--beehive')
+        m.invalidate()
+        self.assertTrue(m.complete_option(u'--be')[0] is b)
+
+        # positions that aren't small ints are distinct objects once decoded
+        d = self._stored(m)
+        d['flags'] = [[flag, i + 1000] for flag, i in d['flags']]
+        e = store.explainmanpage.from_store(d, lambda i: store.option.from_store(d['options'][i - 1000]))
+        self.assertEquals(e.complete_option(u'--be')[1], [u'--bee', u'--beehive'])
+        self.assertEquals(e.complete_option(u'--be')[0], b)
+
+        e = store.explainmanpage.from_store(self._stored(m), None)
+        self.assertEquals(e.complete_option(u'--alm'), (a, [u'--almost']))
+        self.assertEquals(e.complete_option(u'--bee')[0], b)
+        self.assertEquals(e.complete_option(u'--c'), (None, []))
+
+        # the man page changed since, the completion is unknown rather than
+        # ambiguous
+        e = store.explainmanpage.from_store(d, lambda i: None)
+        self.assertEquals(e.complete_option(u'--be'), (None, []))
+
+    def test_arguments(self):
+        a = self._option(1, [u'-a'], [])
+        b = self._option(2, [], [])
+        c = self._option(3, [], [])
+        b.argument = c.argument = 'FILE'
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis', [a, b, c], [])
+        self.assertEquals(m.arguments, {'FILE' : ' desc\n\n desc'})
+        self.assertTrue(m.arguments is m.arguments)
+
+        m.removeoption(3)
+        self.assertEquals(m.arguments, {'FILE' : ' desc'})
+        self.assertEquals(m.options, [a, b])
+        self.assertRaises(ValueError, m.removeoption, 3)
+        self.assertRaises(ValueError, m.removeoption, 4)
+
+    def _stored(self, m):
+        # from_store expects what comes back from mongo
+        d = m.to_store()
+        d['synopsis'] = d['synopsis'].decode('utf8')
+        for pd in d['paragraphs'] + d['options']:
+            pd['text'] = pd['text'].decode('utf8')
+        return d
+
+    def test_explain(self):
+        paragraphs = [store.paragraph(0, 'prose', u'DESCRIPTION', False),
+                      self._option(1, [u'-a'], []),
+                      self._option(2, [u'-b'], [u'--bee']),
+                      self._option(3, [], [u'--cee'])]
+        paragraphs[3].argument = 'FILE'
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis', paragraphs, [('foo', 10)])
+        d = self._stored(m)
+
+        # what _explainfields fetches with STORE_EXPLAIN_OPTIONS = 1
+        options = d.pop('options')
+        del d['paragraphs']
+        d['options'] = options[:1]
+        loaded = []
+        def loadoption(i):
+            loaded.append(i)
+            return store.option.from_store(options[i])
+
+        e = store.explainmanpage.from_store(d, loadoption)
+        self.assertEquals(e.paragraphs, paragraphs[1:2])
+        self.assertEquals(e.find_option('-a'), paragraphs[1])
+        self.assertEquals(loaded, [])
+        self.assertEquals(e.find_option('--bee'), paragraphs[2])
+        self.assertEquals(e.find_option('-b'), paragraphs[2])
+        self.assertEquals(e.find_option('-x'), None)
+        self.assertEquals(loaded, [1])
+        self.assertEquals(e.arguments, {'FILE' : '--cee desc'})
+        self.assertEquals(loaded, [1, 2])
+
+        # the man page changed since d was read
+        e = store.explainmanpage.from_store(d, lambda i: None)
+        self.assertEquals(e.find_option('--bee'), None)
+        self.assertEquals(e.arguments, {})
+
+    def test_compact(self):
+        a = self._option(0, [u'-a'], [u'--all'])
+        b = self._option(1, [u'-a'.encode('utf8').decode('utf8')], [u'--almost'])
+        self.assertTrue(a.short[0] is b.short[0])
+        self.assertTrue(a.section is b.section)
+        self.assertFalse(hasattr(a, '__dict__'))
+
+        # texts loaded from the text collection are shared as is
+        text = 'shared text'
+        pd = {'idx' : 0, 'text' : text, 'section' : u'OPTIONS', 'is_option' : False}
+        self.assertTrue(store.paragraph.from_store(pd).text is text)
+
+        p = store.paragraph(0, '-a desc', u'OPTIONS', True)
+        self.assertNotEqual(a, p)
+        self.assertEquals(a, self._option(0, [u'-a'], [u'--all']))
+
+    def test_compressedtext(self):
+        t = store.compressedtext(zlib.compress('-a desc'))
+        a = store.paragraph(0, t, u'OPTIONS', True)
+        b = store.paragraph(1, t, u'OPTIONS', True)
+        self.assertTrue(callable(a._text))
+        self.assertEquals(a.peektext(), '-a desc')
+        self.assertTrue(isinstance(t._value, tuple))
+        self.assertEquals(a.text, '-a desc')
+        self.assertTrue(b.text is a.text)
+
+    def test_matchcopy(self):
+        prose = store.compressedtext(zlib.compress('prose'))
+        text = store.compressedtext(zlib.compress('-a desc'))
+        o = store.option(store.paragraph(1, text, u'OPTIONS', True), [u'-a'], [], False)
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis',
+                          [store.paragraph(0, prose, u'DESCRIPTION', False), o], [('foo', 10)])
+
+        c = pickle.loads(pickle.dumps(m.matchcopy(), 2))
+        # nothing was decompressed in m
+        self.assertTrue(isinstance(text._value, tuple))
+        self.assertTrue(isinstance(prose._value, tuple))
+
+        self.assertEquals(c.paragraphs, [o])
+        self.assertEquals(c.find_option('-a')._text, '-a desc')
+        self.assertEquals((c.name, c.synopsis, c.aliases), ('foo', 'foo synopsis', [('foo', 10)]))
+
+    def test_concurrentstore(self):
+        class slowstore(object):
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.active = self.maxactive = 0
+                self.batches = []
+            def findmanpages(self, names, explain=False):
+                with self.lock:
+                    self.batches.append(sorted(names))
+                    self.active += 1
+                    self.maxactive = max(self.maxactive, self.active)
+                time.sleep(0.05)
+                with self.lock:
+                    self.active -= 1
+                return dict((name, errors.ProgramDoesNotExist(name)) for name in names)
+            def ping(self):
+                return True
+
+        s = slowstore()
+        cs = store.concurrentstore(s, 4)
+        results = cs.findmanpages(['a', 'b', 'a.1', 'b.2', 'c.1.gz'])
+        self.assertEquals(sorted(results), ['a', 'a.1', 'b', 'b.2', 'c.1.gz'])
+        self.assertEquals(sorted(s.batches), [['a', 'b'], ['a.1'], ['b.2'], ['c.1.gz']])
+        self.assertTrue(s.maxactive > 1)
+        self.assertTrue(cs.ping())
+        self.assertEquals(cs.submit(len, 'abc').get(), 3)
+
+    def test_shared(self):
+        created = []
+        class fakestore(object):
+            schemaerror = None
+            def __init__(self, db, host, **kwargs):
+                self.closed = False
+                created.append(self)
+            def checkschema(self):
+                if self.schemaerror:
+                    raise self.schemaerror
+            def close(self):
+                self.closed = True
+
+        pid = [1]
+        origstore, origgetpid = store.store, store.os.getpid
+        store.store, store.os.getpid = fakestore, lambda: pid[0]
+        try:
+            # one store per pid
+            a = store.shared('test_shared')
+            self.assertTrue(store.shared('test_shared') is a)
+            pid[0] = 2
+            b = store.shared('test_shared')
+            self.assertTrue(b is not a)
+            self.assertTrue(store.shared('test_shared') is b)
+            self.assertEquals(created, [a, b])
+
+            # a store of an outdated db is closed and not kept
+            pid[0] = 3
+            fakestore.schemaerror = errors.SchemaOutdated('outdated')
+            self.assertRaises(errors.SchemaOutdated, store.shared, 'test_shared')
+            self.assertEquals(len(created), 3)
+            self.assertTrue(created[-1].closed)
+            fakestore.schemaerror = None
+            c = store.shared('test_shared')
+            self.assertTrue(c is created[-1])
+            self.assertEquals(len(created), 4)
+            self.assertFalse(c.closed)
+        finally:
+            store.store, store.os.getpid = origstore, origgetpid
+            store._shared.pop(('test_shared', store.config.MONGO_URI), None)
+
+    def test_refreshlookuphashes(self):
+        class collection(object):
+            def __init__(self, docs=()):
+                self.docs = list(docs)
+                self.written = []
+            def find(self, spec=None, fields=None):
+                return [dict(d) for d in self.docs]
+            def update(self, spec, d, upsert=False):
+                # what pymongo would send
+                bson.BSON.encode(d)
+                self.written.append(d)
+
+        # a store without a db, just the collections _refreshlookup uses
+        s = store.store.__new__(store.store)
+        s._texts = util.lrucache(1024, weight=len)
+        s._directory = None
+        text = '-a desc'
+        h = store.texthash(text)
+        s.text = collection([{'_id' : h, 'zlib' : bson.binary.Binary(zlib.compress(text))}])
+        s.mapping = collection([{'src' : 'foo', 'dst' : 1, 'score' : 10}])
+        m = store.manpage('foo.1.gz', 'foo', 'foo synopsis', [self._option(0, [u'-a'], [])],
+                          [('foo', 10)])
+        md = m.to_store()
+        md['_id'] = 1
+        del md['options'][0]['text']
+        md['options'][0]['hash'] = h
+        s.manpage = collection([md])
+        s.lookup = collection()
+
+        s._refreshlookup(['foo'])
+        [d] = s.lookup.written
+        # lookup has the hash of the text, which is loaded through the text
+        # cache and decompressed when read
+        self.assertEquals(d['manpage']['options'][0]['hash'], h)
+        self.assertFalse('text' in d['manpage']['options'][0])
+        s._explains = util.lrucache(10)
+        e = s._loadexplain(1, d['manpage'])
+        self.assertTrue(callable(e.paragraphs[0]._text))
+        self.assertEquals(e.paragraphs[0].text, text)
+
+    def test_loadtextsweight(self):
+        class collection(object):
+            def __init__(self, docs):
+                self.docs = docs
+            def find(self, spec=None, fields=None):
+                return [dict(d) for d in self.docs]
+
+        s = store.store.__new__(store.store)
+        s._texts = util.lrucache(1024, weight=len)
+        text = '-a desc' * 10
+        h = store.texthash(text)
+        s.text = collection([{'_id' : h, 'zlib' : bson.binary.Binary(zlib.compress(text))}])
+
+        def load():
+            d = {'options' : [{'idx' : 0, 'hash' : h}, {'idx' : 1, 'hash' : h}]}
+            s._loadtexts([d])
+            return [store.paragraph.from_store(dict(od, section=u'OPTIONS', is_option=True))
+                    for od in d['options']]
+
+        a, b = load()
+        self.assertEquals(a.text, text)
+        self.assertTrue(b.text is a.text)
+        # the cached text stays compressed, so the cache's weight of it holds
+        size = s._texts.stats()['size']
+        self.assertEquals(size, len(zlib.compress(text)))
+        self.assertEquals(str(s._texts[h].compressed()), zlib.compress(text))
+        c, _ = load()
+        self.assertEquals(c.text, text)
+        self.assertEquals(s._texts.stats()['size'], size)
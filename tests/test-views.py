@@ -0,0 +1,73 @@
+import unittest
+
+import pymongo.errors
+
+from explainshell import store, errors, util
+from explainshell.web import app, views
+from tests import helpers
+
+class test_views(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self._shared = store.shared
+        self._explained = views._explained
+        views._explained = util.lrucache(1024 * 1024, weight=len)
+
+    def tearDown(self):
+        store.shared = self._shared
+        views._explained = self._explained
+
+    def test_health(self):
+        class pingstore(object):
+            def __init__(self, up):
+                self.up = up
+            def ping(self):
+                return self.up
+
+        store.shared = lambda db, host: pingstore(True)
+        r = self.client.get('/health')
+        self.assertEquals((r.status_code, r.data), (200, 'ok'))
+
+        store.shared = lambda db, host: pingstore(False)
+        self.assertEquals(self.client.get('/health').status_code, 503)
+
+        for e in (errors.SchemaOutdated('outdated'),
+                  pymongo.errors.ConnectionFailure('down')):
+            def failing(db, host, e=e):
+                raise e
+            store.shared = failing
+            self.assertEquals(self.client.get('/health').status_code, 503)
+
+    def test_explaincache(self):
+        class countingstore(helpers.mockstore):
+            key = ('', 1)
+            lookups = 0
+            def findmanpages(self, names, explain=False):
+                self.lookups += 1
+                return helpers.mockstore.findmanpages(self, names, explain)
+            def cachekey(self):
+                return self.key
+
+        s = countingstore()
+        store.shared = lambda db, host: s
+
+        r = self.client.get('/explain?cmd=bar+-a')
+        self.assertEquals(r.status_code, 200)
+        self.assertTrue('-a desc' in r.data)
+        self.assertEquals(s.lookups, 1)
+
+        # the same command is served from the cache
+        self.assertEquals(self.client.get('/explain?cmd=bar+-a').data, r.data)
+        self.assertEquals(s.lookups, 1)
+
+        # until the generation changes
+        s.key = ('', 2)
+        self.assertEquals(self.client.get('/explain?cmd=bar+-a').data, r.data)
+        self.assertEquals(s.lookups, 2)
+        self.assertEquals(len(views._explained), 2)
+
+        # errors aren't cached
+        r = self.client.get('/explain?cmd=nothere+-a')
+        self.assertEquals(r.status_code, 200)
+        self.client.get('/explain?cmd=nothere+-a')
+        self.assertEquals(s.lookups, 4)